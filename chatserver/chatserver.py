@@ -1,37 +1,122 @@
-from asyncore import dispatcher
-from asynchat import async_chat
-from typing import List, Optional
-import socket
-import asyncore
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from hmac import compare_digest
+from time import monotonic, perf_counter
+from typing import Deque, Optional
+import argparse
+import asyncio
+import json
+import os
+
+from metrics import Metrics, METRICS_HOST
 
 PORT = 5005
 NAME = "TestChat"
+BACKLOG = 1024
+
+# Bytes waiting for a single client
+HIGH_WATER = 1024 * 1024
+LOW_WATER = 256 * 1024
+
+# What to do when a client falls behind
+DROP_OLDEST = "drop_oldest"
+PAUSE = "pause"
+DROP_SESSION = "drop_session"
+
+MAIN_ROOM = "main"
+MAX_ROOM_NAME = 32
+
+# Token bucket limits per session as (commands per second, burst). "any"
+# applies to every command, the others to the commands in COMMAND_CLASSES.
+LIMITS = {"any": (10, 20), "query": (1, 5)}
+COMMAND_CLASSES = {"look": "query", "who": "query", "rooms": "query"}
+
+# Lines of history a room keeps and replays to users who enter it
+HISTORY_SIZE = 50
+# Seconds between syncs of the history log to disk
+FSYNC_INTERVAL = 1.0
+# Bytes the history log may grow to before it is rotated, and the most
+# rooms whose history is loaded from it
+LOG_SIZE = 8 * 1024 * 1024
+LOG_ROOMS = 1000
+
+# Bytes read from a socket at a time, the longest line a client may send,
+# and the longest command name
+READ_SIZE = 64 * 1024
+MAX_LINE = 4096
+MAX_COMMAND = 16
 
 
 class EndSession(Exception):
     pass
 
 
+class TokenBucket:
+    """
+    Allows rate events per second on average and up to burst at once.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = monotonic()
+
+    def take(self, now):
+        tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if tokens < 1:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - 1
+        return True
+
+
 class CommandHandler:
     """
     Simple command handler similar to cmd.Cmd from the standard library.
+    Commands over the session's rate limits are rejected before dispatch.
     """
 
     def unknown(self, session, cmd):
         session.push(f"Unknown command: {cmd}s\r\n".encode())
 
+    def limited(self, session, cmd):
+        session.push(b"Slow down\r\n")
+
+    def too_long(self, session):
+        session.push(b"Command too long\r\n")
+
     def handle(self, session, line):
-        if not line.strip():
+        """
+        Runs the command on a line of bytes (or a memoryview of them). Only
+        the start of the line is copied to find the command, and the rest is
+        decoded only if the command is allowed and has an argument.
+        """
+        head = bytes(line[:MAX_COMMAND + 1])
+        if not head.strip():
+            # Only a line that starts out blank needs copying in full
+            if len(line) <= MAX_COMMAND or not bytes(line).strip():
+                return
+
+        end = head.find(b" ")
+        if end < 0:
+            end = len(line)
+        cmd = head[:end].decode(errors="replace")
+
+        if not session.allow(cmd):
+            self.limited(session, cmd)
             return
 
-        parts = line.split(" ", 1)
-        cmd = parts[0]
-        try:
-            line = parts[1].strip()
-        except IndexError:
-            line = ""
+        if end > MAX_COMMAND:
+            self.too_long(session)
+            return
 
         meth = getattr(self, f"do_{cmd}", None)
+        if end < len(line):
+            line = bytes(line[end + 1:]).decode(errors="replace").strip()
+        else:
+            line = ""
         try:
             meth(session, line)
         except TypeError:
@@ -46,17 +131,24 @@ class Room(CommandHandler):
 
     def __init__(self, server):
         self.server = server
-        self.sessions = []
+        # A dict rather than a set keeps the sessions in the order they came
+        self.sessions = {}
 
     def add(self, session):
-        self.sessions.append(session)
+        self.sessions[session] = None
 
     def remove(self, session):
-        self.sessions.remove(session)
+        self.sessions.pop(session, None)
 
     def broadcast(self, line):
+        """
+        Encodes the line once and queues the same bytes on every session.
+        """
+        self.deliver(line.encode())
+
+    def deliver(self, data):
         for session in self.sessions:
-            session.push(line.encode())
+            session.push(data)
 
     def do_logout(self, session, line):
         raise EndSession
@@ -86,32 +178,129 @@ class LoginRoom(Room):
             session.enter(self.server.main_room)
 
 
+def name_list(header, names):
+    """
+    Builds the reply to look and who as a single block of bytes.
+    """
+    lines = [header] + [str(name) for name in names]
+    return "".join(line + "\r\n" for line in lines).encode()
+
+
 class ChatRoom(Room):
     """
     A room meant for multiple users who can chat with the others in the room.
+    Users can move between named rooms with join and part; a room other than
+    the main room is created when someone joins it and closed when the last
+    user leaves.
+
+    The room keeps its latest broadcasts, already encoded, and sends them
+    to every user who enters in a single push.
     """
 
+    def __init__(self, server, name=MAIN_ROOM):
+        super().__init__(server)
+        self.name = name
+        self.look_cache = None
+        self.broadcasts = 0
+        self.deliveries = 0
+        self.history = server.histories.pop(name, None) or deque(
+            maxlen=server.history_size)
+
     def add(self, session):
         self.broadcast(session.name + " has entered the room.\r\n")
         self.server.users[session.name] = session
+        self.server.who_cache = None
         super().add(session)
+        self.look_cache = None
+        if self.history:
+            session.push(b"".join(self.history))
+
+    def broadcast(self, line):
+        data = line.encode()
+        self.broadcasts += 1
+        self.deliveries += len(self.sessions)
+        self.history.append(data)
+        if self.server.log is not None:
+            self.server.log.write(self.name, data)
+        self.deliver(data)
 
     def remove(self, session):
         super().remove(session)
+        self.look_cache = None
         self.broadcast(session.name + " has left the room.\r\n")
+        if not self.sessions and self is not self.server.main_room:
+            self.server.rooms.pop(self.name, None)
+            self.server.keep_history(self.name, self.history)
 
     def do_say(self, session, line):
         self.broadcast(session.name + ": " + line + "\r\n")
 
     def do_look(self, session, line):
-        session.push("The following are in this room:\r\n".encode())
-        for other in self.sessions:
-            session.push(f"{other.name}\r\n".encode())
+        if self.look_cache is None:
+            self.look_cache = name_list(
+                "The following are in this room:",
+                (other.name for other in self.sessions))
+        session.push(self.look_cache)
 
     def do_who(self, session, line):
-        session.push("The following are logged in:\r\n".encode())
-        for name in self.server.users:
-            session.push(f"{name}\r\n".encode())
+        server = self.server
+        if server.who_cache is None:
+            server.who_cache = name_list("The following are logged in:",
+                                         server.users)
+        session.push(server.who_cache)
+
+    def do_stats(self, session, line):
+        """
+        Shows the server's metrics to users who give the stats token.
+        """
+        server = self.server
+        token = server.stats_token
+        if token is None or not compare_digest(line.strip().encode(),
+                                               token.encode()):
+            self.unknown(session, "stats")
+            return
+        metrics = server.metrics
+        backlogs = [other.backlog() for other in server.sessions]
+        lines = [
+            f"sessions: {len(server.sessions)}",
+            f"users: {len(server.users)}",
+            f"rooms: {len(server.rooms)}",
+            f"bytes in: {metrics.bytes_in}",
+            f"bytes out: {metrics.bytes_out}",
+            f"queued bytes: {sum(backlogs)} (max {max(backlogs, default=0)})",
+            f"evictions: {server.evictions}",
+            f"loop lag: {metrics.loop_lag:.6f}s "
+            f"(max {metrics.loop_lag_max:.6f}s)",
+        ]
+        lines += [f"room {room.name}: {len(room.sessions)} members, "
+                  f"{room.broadcasts} broadcasts, {room.deliveries} deliveries"
+                  for room in server.rooms.values()]
+        session.push("".join(line + "\r\n" for line in lines).encode())
+
+    def do_join(self, session, line):
+        name = line.strip()
+        if not name:
+            session.push("Please enter a room name\r\n".encode())
+        elif len(name) > MAX_ROOM_NAME or not name.isprintable():
+            session.push(f"Room names are at most {MAX_ROOM_NAME} printable "
+                         "characters\r\n".encode())
+        elif name == self.name:
+            session.push(f"You are already in {name}\r\n".encode())
+        else:
+            session.enter(self.server.room(name))
+            session.push(f"You are now in {name}\r\n".encode())
+
+    def do_part(self, session, line):
+        if self is self.server.main_room:
+            session.push("You are in the main room\r\n".encode())
+        else:
+            session.enter(self.server.main_room)
+            session.push(f"You are now in {MAIN_ROOM}\r\n".encode())
+
+    def do_rooms(self, session, line):
+        session.push("The following rooms are open:\r\n".encode())
+        for room in self.server.rooms.values():
+            session.push(f"{room.name} ({len(room.sessions)})\r\n".encode())
 
 
 class LogoutRoom(Room):
@@ -125,24 +314,49 @@ class LogoutRoom(Room):
             del self.server.users[session.name]
         except KeyError:
             pass
+        else:
+            self.server.who_cache = None
 
 
-class ChatSession(async_chat):
+class ChatSession:
     """
     A single session, which takes care of the communication with a single user.
+
+    Pushed data is queued and written by a separate task, which waits for
+    the socket to drain before writing more. When the bytes waiting for a
+    client would exceed the server's high watermark, the server's overflow
+    policy decides what happens: DROP_OLDEST discards the oldest queued
+    messages, PAUSE stops delivering new messages until the backlog falls
+    below the low watermark, and DROP_SESSION disconnects the client.
     """
 
-    data: List[bytes]
     name: Optional[str]
+    queue: Deque[bytes]
 
-    def __init__(self, server, sock):
-        super().__init__(sock)
+    def __init__(self, server, reader, writer):
         self.server = server
-        self.set_terminator(b"\r\n")
-        self.data = []
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
         self.name = None
-
-        self.enter(LoginRoom(server))
+        self.buffer = bytearray()
+        self.scan = 0
+        self.skipping = False
+        self.closed = False
+        self.paused = False
+        self.queue = deque()
+        self.queued = 0
+        self.ready = asyncio.Event()
+        self.bytes_sent = 0
+        self.dropped_messages = 0
+        self.dropped_bytes = 0
+        self.rejected = 0
+        self.buckets = {name: TokenBucket(rate, burst)
+                        for name, (rate, burst) in server.limits.items()}
+        writer.transport.set_write_buffer_limits(server.high_water,
+                                                 server.low_water)
+
+        self.enter(server.login_room(server))
 
     def enter(self, room):
         try:
@@ -154,46 +368,427 @@ class ChatSession(async_chat):
         self.room = room
         room.add(self)
 
-    def collect_incoming_data(self, data: bytes) -> None:
-        self.data.append(data)
+    def allow(self, cmd):
+        """
+        Takes a token for the command from the session's buckets.
+        """
+        now = monotonic()
+        for name in ("any", COMMAND_CLASSES.get(cmd)):
+            bucket = self.buckets.get(name)
+            if bucket is not None and not bucket.take(now):
+                self.rejected += 1
+                return False
+        return True
+
+    def backlog(self):
+        """
+        Returns the number of bytes waiting to be sent to the client.
+        """
+        return self.queued + self.writer.transport.get_write_buffer_size()
+
+    def push(self, data: bytes) -> None:
+        """
+        Queues data for the client. Everything pushed during one iteration
+        of the event loop goes out in a single write.
+        """
+        if self.closed:
+            return
+        # The transport only reports when its buffer drains past the high
+        # watermark, so a pause that started below it is lifted here.
+        if self.paused and self.backlog() <= self.server.low_water:
+            self.paused = False
+        if self.paused or self.backlog() + len(data) > self.server.high_water:
+            if not self.overflow(data):
+                return
+        self.queue.append(data)
+        self.queued += len(data)
+        self.ready.set()
+
+    def overflow(self, data):
+        """
+        Applies the overflow policy. Returns whether data may still be queued.
+        """
+        policy = self.server.policy
+        if policy == DROP_OLDEST:
+            limit = self.server.high_water - len(data)
+            while self.queue and self.backlog() > limit:
+                old = self.queue.popleft()
+                self.queued -= len(old)
+                self.drop(old)
+            if self.backlog() <= limit:
+                return True
+        elif policy == PAUSE:
+            self.paused = True
+        else:
+            self.evict()
+            return False
+        self.drop(data)
+        return False
+
+    def drop(self, data):
+        self.dropped_messages += 1
+        self.dropped_bytes += len(data)
+
+    def evict(self):
+        """
+        Disconnects a client that does not keep up, discarding its backlog.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.server.evictions += 1
+        self.queue.clear()
+        self.queued = 0
+        self.ready.set()
+        self.writer.transport.abort()
+        # The session may be evicted in the middle of a broadcast, so it
+        # leaves its room only after the broadcast is done.
+        self.loop.call_soon(self.enter, self.server.logout_room(self.server))
+
+    async def write_loop(self):
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                if self.closed:
+                    return
+                data = self.queue
+                self.queue = deque()
+                self.queued = 0
+                self.writer.writelines(data)
+                size = sum(map(len, data))
+                self.bytes_sent += size
+                self.server.metrics.bytes_out += size
+                await self.writer.drain()
+                if self.paused and self.backlog() <= self.server.low_water:
+                    self.paused = False
+        except ConnectionError:
+            pass
 
-    def found_terminator(self):
-        line = b"".join(self.data)
-        line = line.decode()
-        self.data = []
+    async def run(self):
+        """
+        Reads lines until the client disconnects or logs out.
+        """
+        writing = asyncio.create_task(self.write_loop())
+        try:
+            while not self.closed:
+                try:
+                    data = await self.reader.read(READ_SIZE)
+                except ConnectionError:
+                    break
+                if not data:
+                    break
+                self.server.metrics.bytes_in += len(data)
+                self.buffer += data
+                self.frame()
+        finally:
+            self.handle_close()
+            writing.cancel()
+
+    def frame(self):
+        """
+        Hands every complete line in the receive buffer to found_terminator
+        as a memoryview of the buffer, then drops the consumed bytes. Lines
+        longer than MAX_LINE are discarded.
+        """
+        buffer = self.buffer
+        start = 0
+        with memoryview(buffer) as view:
+            while not self.closed:
+                end = buffer.find(b"\r\n", self.scan)
+                if end < 0:
+                    break
+                if self.skipping:
+                    self.skipping = False
+                elif end - start > MAX_LINE:
+                    self.line_too_long()
+                else:
+                    with view[start:end] as line:
+                        self.found_terminator(line)
+                start = self.scan = end + 2
+
+        if len(buffer) - start > MAX_LINE:
+            if not self.skipping:
+                self.skipping = True
+                self.line_too_long()
+            # Keep a trailing \r in case the \n is in the next chunk
+            start = len(buffer) - 1
+        del buffer[:start]
+        self.scan = max(len(buffer) - 1, 0)
+
+    def line_too_long(self):
+        self.push(f"Lines are limited to {MAX_LINE} bytes\r\n".encode())
+
+    def found_terminator(self, line):
+        start = perf_counter()
         try:
             self.room.handle(self, line)
         except EndSession:
             self.handle_close()
+        metrics = self.server.metrics
+        metrics.lines += 1
+        metrics.line_seconds.observe(perf_counter() - start)
 
     def handle_close(self):
-        super().handle_close()
-        self.enter(LogoutRoom(self.server))
-
+        if self.closed:
+            return
+        self.closed = True
+        if self.queue:
+            self.writer.writelines(self.queue)
+            self.queue.clear()
+            self.queued = 0
+        self.writer.close()
+        self.enter(self.server.logout_room(self.server))
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "queued_bytes": self.backlog(),
+            "sent_bytes": self.bytes_sent,
+            "dropped_messages": self.dropped_messages,
+            "dropped_bytes": self.dropped_bytes,
+            "rejected_commands": self.rejected,
+            "paused": self.paused,
+        }
+
+
+class HistoryLog:
+    """
+    An append-only log of room broadcasts, one JSON object per line with
+    the room and the line, so neither can break the framing. Writes are
+    buffered and the file is synced to disk at most once every interval
+    seconds, not once per message. When the log grows past max_size bytes
+    it is moved to "<path>.1", replacing the previous one, so at most about
+    twice max_size is kept and read back.
+
+    The syncs and the rotation run on a single writer thread, in order, so
+    they never hold up the event loop. Records written while a rotation is
+    under way are held in memory until the new file can be opened.
+    """
 
-class ChatServer(dispatcher):
+    def __init__(self, path, interval=FSYNC_INTERVAL, max_size=LOG_SIZE,
+                 max_rooms=LOG_ROOMS):
+        self.path = path
+        self.interval = interval
+        self.max_size = max_size
+        self.max_rooms = max_rooms
+        self.file = None
+        self.pending = None
+        self.held = None
+        self.writer = ThreadPoolExecutor(1)
+
+    def load(self, size):
+        """
+        Returns the last size lines of each of the max_rooms rooms most
+        recently written to in the log.
+        """
+        histories = OrderedDict()
+        for path in (self.path + ".1", self.path):
+            try:
+                with open(path, "rb") as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                            room = record["room"]
+                            data = record["line"].encode()
+                        except (ValueError, KeyError, TypeError,
+                                AttributeError):
+                            # A torn write or an old record
+                            continue
+                        try:
+                            histories.move_to_end(room)
+                        except KeyError:
+                            histories[room] = deque(maxlen=size)
+                            if len(histories) > self.max_rooms:
+                                histories.popitem(last=False)
+                        histories[room].append(data)
+            except FileNotFoundError:
+                pass
+        return histories
+
+    def write(self, room, data):
+        record = {"room": room, "line": data.decode(errors="replace")}
+        record = json.dumps(record).encode() + b"\n"
+        if self.held is not None:
+            self.held.append(record)
+        else:
+            self.append(record)
+
+    def append(self, record):
+        if self.file is None:
+            self.file = open(self.path, "ab")
+        self.file.write(record)
+        if self.file.tell() >= self.max_size:
+            self.rotate()
+        elif self.pending is None:
+            self.pending = asyncio.get_running_loop().call_later(
+                self.interval, self.sync)
+
+    def sync(self):
+        self.pending = None
+        if self.file is not None:
+            self.file.flush()
+            asyncio.get_running_loop().run_in_executor(
+                self.writer, os.fsync, self.file.fileno())
+
+    def rotate(self):
+        if self.pending is not None:
+            self.pending.cancel()
+            self.pending = None
+        file, self.file = self.file, None
+        self.held = []
+        rotation = asyncio.get_running_loop().run_in_executor(
+            self.writer, self.retire, file)
+        rotation.add_done_callback(self.rotated)
+
+    def retire(self, file):
+        """
+        Runs on the writer thread to close a full log and move it aside.
+        """
+        file.flush()
+        os.fsync(file.fileno())
+        file.close()
+        os.replace(self.path, self.path + ".1")
+
+    def rotated(self, future):
+        held, self.held = self.held, None
+        for record in held or ():
+            self.append(record)
+
+    def close(self):
+        if self.pending is not None:
+            self.pending.cancel()
+            self.pending = None
+        # Waits for the syncs and any rotation still queued
+        self.writer.shutdown()
+        held, self.held = self.held, None
+        if held and self.file is None:
+            self.file = open(self.path, "ab")
+        if self.file is not None:
+            self.file.writelines(held or ())
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+
+
+class ChatServer:
     """
-    A chat server with a single room.
+    A chat server with a main room and any number of named rooms.
+    Subclasses can swap the room classes through the class attributes.
     """
 
-    def __init__(self, port, name):
-        super().__init__()
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.set_reuse_addr()
-        self.bind(("", port))
-        self.listen(5)
+    login_room = LoginRoom
+    chat_room = ChatRoom
+    logout_room = LogoutRoom
+    reuse_port = False
+
+    def __init__(self, port, name, high_water=HIGH_WATER, low_water=LOW_WATER,
+                 policy=DROP_SESSION, limits=LIMITS, history_size=HISTORY_SIZE,
+                 log_path=None, metrics_port=None,
+                 metrics_host=METRICS_HOST, stats_token=None):
+        self.port = port
         self.name = name
+        self.high_water = high_water
+        self.low_water = low_water
+        self.policy = policy
+        self.limits = limits
         self.users = {}
-        self.main_room = ChatRoom(self)
+        self.who_cache = None
+        self.sessions = set()
+        self.evictions = 0
+        self.metrics = Metrics()
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self.stats_token = stats_token
+        self.history_size = history_size
+        self.log = None
+        self.histories = OrderedDict()
+        if log_path is not None:
+            self.log = HistoryLog(log_path)
+            self.histories = self.log.load(history_size)
+        self.main_room = self.chat_room(self)
+        self.rooms = {MAIN_ROOM: self.main_room}
+
+    def keep_history(self, name, history):
+        """
+        Keeps the history of a room that has closed, for when it is opened
+        again, dropping that of the room closed longest ago if there are
+        more than LOG_ROOMS.
+        """
+        if not history:
+            return
+        self.histories[name] = history
+        self.histories.move_to_end(name)
+        while len(self.histories) > LOG_ROOMS:
+            self.histories.popitem(last=False)
+
+    def room(self, name):
+        """
+        Returns the room with the given name, creating it if needed.
+        """
+        try:
+            return self.rooms[name]
+        except KeyError:
+            room = self.rooms[name] = self.chat_room(self, name)
+            return room
 
-    def handle_accept(self):
-        conn, addr = self.accept()
-        ChatSession(self, conn)
+    async def handle_accept(self, reader, writer):
+        self.metrics.connections += 1
+        session = ChatSession(self, reader, writer)
+        self.sessions.add(session)
+        try:
+            await session.run()
+        finally:
+            self.sessions.discard(session)
+
+    def queue_stats(self):
+        """
+        Returns the output queue counters of every connected session.
+        """
+        return [session.stats() for session in self.sessions]
+
+    async def serve_forever(self):
+        server = await asyncio.start_server(
+            self.handle_accept, port=self.port, reuse_address=True,
+            reuse_port=self.reuse_port, backlog=BACKLOG)
+        tasks = [asyncio.create_task(self.metrics.monitor_lag())]
+        if self.metrics_port is not None:
+            tasks.append(asyncio.create_task(
+                self.metrics.serve(self, self.metrics_port,
+                                   self.metrics_host)))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+            if self.log is not None:
+                self.log.close()
 
 
 if __name__ == "__main__":
-    s = ChatServer(PORT, NAME)
+    parser = argparse.ArgumentParser(description="Run the chat server.")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--name", default=NAME)
+    parser.add_argument("--log", help="file to keep the room history in")
+    parser.add_argument("--metrics-port", type=int,
+                        help="port to serve Prometheus metrics on")
+    parser.add_argument("--metrics-host", default=METRICS_HOST,
+                        help="address to serve the metrics on (default: "
+                        "%(default)s)")
+    parser.add_argument("--stats-token",
+                        default=os.environ.get("CHAT_STATS_TOKEN"),
+                        help="secret to give with the stats command "
+                        "(default: $CHAT_STATS_TOKEN; without one the "
+                        "command is disabled)")
+    args = parser.parse_args()
+
+    s = ChatServer(args.port, args.name, log_path=args.log,
+                   metrics_port=args.metrics_port,
+                   metrics_host=args.metrics_host,
+                   stats_token=args.stats_token)
     try:
-        asyncore.loop()
+        asyncio.run(s.serve_forever())
     except KeyboardInterrupt:
         print()
@@ -0,0 +1,198 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+
+MARKER = "LOADGEN"
+
+
+def rss(pid):
+    """
+    Returns the resident set size of a process in bytes (Linux only).
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+class Stats:
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.limited = 0
+        self.failed = 0
+        self.latencies = []
+
+
+class Client:
+    """
+    A simulated user. It logs in (unless the server has no login), sends
+    timestamped lines at a given rate, and times every timestamped line it
+    gets back, its own and other clients'.
+    """
+
+    def __init__(self, index, host, port, login, stats):
+        self.index = index
+        self.host = host
+        self.port = port
+        self.login = login
+        self.stats = stats
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port)
+        if self.login:
+            self.writer.write(f"login lg{self.index}\r\n".encode())
+        self.reading = asyncio.create_task(self.read())
+
+    async def read(self):
+        stats = self.stats
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                now = time.perf_counter_ns()
+                text = line.decode(errors="replace")
+                index = text.find(MARKER)
+                if index >= 0:
+                    try:
+                        sent = int(text[index:].split()[2])
+                    except (IndexError, ValueError):
+                        continue
+                    stats.received += 1
+                    stats.latencies.append((now - sent) / 1e9)
+                elif text.startswith("Slow down"):
+                    stats.limited += 1
+        except ConnectionError:
+            pass
+
+    async def send(self, rate, duration):
+        interval = 1 / rate
+        # Spread the clients over the first interval
+        await asyncio.sleep(random.random() * interval)
+        deadline = time.monotonic() + duration
+        prefix = "say " if self.login else ""
+        try:
+            while time.monotonic() < deadline:
+                stamp = time.perf_counter_ns()
+                self.writer.write(
+                    f"{prefix}{MARKER} {self.index} {stamp}\r\n".encode())
+                self.stats.sent += 1
+                await self.writer.drain()
+                await asyncio.sleep(interval)
+        except ConnectionError:
+            self.stats.failed += 1
+
+    def close(self):
+        self.reading.cancel()
+        self.writer.close()
+
+
+async def run(args):
+    stats = Stats()
+    clients = [Client(i, args.host, args.port, not args.simple, stats)
+               for i in range(args.clients)]
+    limit = asyncio.Semaphore(args.connect_concurrency)
+
+    async def connect(client):
+        async with limit:
+            try:
+                await client.connect()
+                return client
+            except OSError:
+                stats.failed += 1
+
+    start = time.monotonic()
+    connected = [c for c in await asyncio.gather(*map(connect, clients)) if c]
+    connect_time = time.monotonic() - start
+    await asyncio.sleep(args.settle)
+
+    peak_rss = rss(args.pid) if args.pid else None
+
+    async def sample():
+        nonlocal peak_rss
+        while True:
+            await asyncio.sleep(0.5)
+            value = rss(args.pid)
+            if value is not None:
+                peak_rss = max(peak_rss or 0, value)
+
+    sampling = asyncio.create_task(sample()) if args.pid else None
+    stats.latencies.clear()
+    stats.received = 0
+    start = time.monotonic()
+    await asyncio.gather(*(c.send(args.rate, args.duration)
+                           for c in connected))
+    await asyncio.sleep(args.settle)
+    elapsed = time.monotonic() - start
+    if sampling is not None:
+        sampling.cancel()
+    for client in connected:
+        client.close()
+
+    latencies = sorted(stats.latencies)
+    return {
+        "clients": len(connected),
+        "connect_seconds": connect_time,
+        "failed": stats.failed,
+        "sent": stats.sent,
+        "received": stats.received,
+        "rate_limited": stats.limited,
+        "sent_per_second": stats.sent / elapsed,
+        "received_per_second": stats.received / elapsed,
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p90": percentile(latencies, 0.9),
+        "latency_p99": percentile(latencies, 0.99),
+        "latency_max": latencies[-1] if latencies else None,
+        "server_rss_peak": peak_rss,
+        "server_rss_end": rss(args.pid) if args.pid else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load test chatserver.py or simple_chat.py.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5005)
+    parser.add_argument("-c", "--clients", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=1.0,
+                        help="lines per second sent by each client")
+    parser.add_argument("--duration", type=float, default=10.0,
+                        help="seconds to keep sending")
+    parser.add_argument("--settle", type=float, default=1.0,
+                        help="seconds to wait after connecting and sending")
+    parser.add_argument("--connect-concurrency", type=int, default=200,
+                        help="connections opened at once")
+    parser.add_argument("--simple", action="store_true",
+                        help="target simple_chat.py, which has no login")
+    parser.add_argument("--pid", type=int,
+                        help="server process whose memory to sample")
+    parser.add_argument("--json", metavar="FILE",
+                        help="also write the results as JSON to FILE")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    for key, value in results.items():
+        if isinstance(value, float):
+            value = f"{value:.6f}"
+        print(f"{key:22} {value}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
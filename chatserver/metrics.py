@@ -0,0 +1,178 @@
+from bisect import bisect_left
+import asyncio
+
+METRICS_HOST = "127.0.0.1"
+READ_TIMEOUT = 5.0  # Seconds a scraper may take to send its request
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+LAG_INTERVAL = 0.5
+
+
+class Histogram:
+    """
+    Counts observations in fixed buckets, like a Prometheus histogram.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, help):
+        lines = [f"# HELP {name} {help}", f"# TYPE {name} histogram"]
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {total}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum {self.sum}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+
+def label(name, value):
+    """
+    Formats a label, escaping the value as the text format requires.
+    """
+    value = (str(value).replace("\\", "\\\\").replace('"', '\\"')
+             .replace("\n", "\\n"))
+    return f'{name}="{value}"'
+
+
+def metric(name, kind, help, value, labels=None):
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    if labels is None:
+        lines.append(f"{name} {value}")
+    else:
+        for labels_text, label_value in labels:
+            lines.append(f'{name}{{{labels_text}}} {label_value}')
+    return lines
+
+
+class Metrics:
+    """
+    Counters for a ChatServer. Sessions add to them as they go; the gauges
+    are read from the server when the metrics are rendered.
+    """
+
+    def __init__(self):
+        self.connections = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.lines = 0
+        self.loop_lag = 0.0
+        self.loop_lag_max = 0.0
+        self.lag_seconds = Histogram()
+        self.line_seconds = Histogram()
+
+    async def monitor_lag(self, interval=LAG_INTERVAL):
+        """
+        Measures how late the event loop wakes up from a sleep.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            lag = max(loop.time() - start - interval, 0.0)
+            self.loop_lag = lag
+            self.loop_lag_max = max(self.loop_lag_max, lag)
+            self.lag_seconds.observe(lag)
+
+    def render(self, server):
+        """
+        Returns the metrics in the Prometheus text format.
+        """
+        backlogs = [session.backlog() for session in server.sessions]
+        rooms = server.rooms.values()
+        lines = []
+        lines += metric("chat_sessions", "gauge", "Connected sessions",
+                        len(server.sessions))
+        lines += metric("chat_users", "gauge", "Logged in users",
+                        len(server.users))
+        lines += metric("chat_rooms", "gauge", "Open rooms", len(rooms))
+        lines += metric("chat_connections_total", "counter",
+                        "Accepted connections", self.connections)
+        lines += metric("chat_received_bytes_total", "counter",
+                        "Bytes received from clients", self.bytes_in)
+        lines += metric("chat_sent_bytes_total", "counter",
+                        "Bytes written to clients", self.bytes_out)
+        lines += metric("chat_lines_total", "counter",
+                        "Lines handled", self.lines)
+        lines += metric("chat_evictions_total", "counter",
+                        "Sessions dropped for falling behind",
+                        server.evictions)
+        lines += metric("chat_queued_bytes", "gauge",
+                        "Bytes waiting to be sent, all sessions",
+                        sum(backlogs))
+        lines += metric("chat_queued_bytes_max", "gauge",
+                        "Bytes waiting to be sent, largest session",
+                        max(backlogs, default=0))
+        lines += metric("chat_room_members", "gauge", "Sessions per room",
+                        None, [(label("room", room.name), len(room.sessions))
+                               for room in rooms])
+        lines += metric("chat_room_broadcasts_total", "counter",
+                        "Broadcasts per room", None,
+                        [(label("room", room.name), room.broadcasts)
+                         for room in rooms])
+        lines += metric("chat_room_deliveries_total", "counter",
+                        "Broadcast fan-out, messages queued per room", None,
+                        [(label("room", room.name), room.deliveries)
+                         for room in rooms])
+        lines += metric("chat_loop_lag_seconds", "gauge",
+                        "Latest event loop lag", self.loop_lag)
+        lines += metric("chat_loop_lag_max_seconds", "gauge",
+                        "Largest event loop lag", self.loop_lag_max)
+        lines += self.lag_seconds.render(
+            "chat_loop_lag_histogram_seconds", "Event loop lag")
+        lines += self.line_seconds.render(
+            "chat_line_seconds",
+            "Time from a complete line to its broadcasts being queued")
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, server, port, host=METRICS_HOST):
+        """
+        Serves GET /metrics over HTTP on its own port. It only listens on
+        the loopback interface unless told otherwise, since the metrics
+        include room names.
+        """
+
+        async def read_request(reader):
+            request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+            return request
+
+        async def handle(reader, writer):
+            try:
+                try:
+                    request = await asyncio.wait_for(read_request(reader),
+                                                     READ_TIMEOUT)
+                except (ValueError, asyncio.TimeoutError):
+                    # Too long or too slow
+                    return
+                parts = request.split()
+                if len(parts) >= 2 and parts[1] == b"/metrics":
+                    status = "200 OK"
+                    body = self.render(server).encode()
+                else:
+                    status = "404 Not Found"
+                    body = b"Not found\n"
+                writer.write(
+                    f"HTTP/1.0 {status}\r\n"
+                    "Content-Type: text/plain; version=0.0.4\r\n"
+                    f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+                await writer.drain()
+            except ConnectionError:
+                pass
+            finally:
+                writer.close()
+
+        listener = await asyncio.start_server(handle, host, port,
+                                              reuse_address=True)
+        async with listener:
+            await listener.serve_forever()
@@ -0,0 +1,310 @@
+from itertools import count
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import tempfile
+
+from chatserver import (ChatServer, ChatRoom, LoginRoom, LogoutRoom, PORT,
+                        NAME)
+
+HUB_LIMIT = 1024 * 1024  # Longest message on the hub connections
+# Bytes that may wait to be sent on a hub connection before broadcasts for
+# it are dropped
+HUB_HIGH_WATER = 4 * 1024 * 1024
+NAMES_PER_REPLY = 1000
+
+
+class Hub:
+    """
+    Runs in the parent process and connects the workers. It owns the global
+    table of nicks and forwards every room broadcast from one worker to all
+    the others. Messages are JSON objects, one per line. Long replies are
+    split into several, all but the last marked with "more".
+
+    A worker that does not read its connection fast enough misses the
+    broadcasts that would take its backlog past HUB_HIGH_WATER, so it
+    cannot make the hub's buffers grow without bound. Replies are always
+    sent, since they are small and a worker waits for them.
+    """
+
+    def __init__(self):
+        self.workers = {}
+        self.users = {}
+        self.dropped = 0
+
+    async def handle(self, reader, writer):
+        self.workers[writer] = set()
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # Longer than HUB_LIMIT; the rest of it is skipped too
+                    continue
+                if not line:
+                    break
+                try:
+                    msg = json.loads(line)
+                    method = getattr(self, "do_" + msg["op"])
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    # Skip a bad message rather than lose the worker
+                    continue
+                method(writer, msg, line)
+        except ConnectionError:
+            pass
+        finally:
+            for nick in self.workers.pop(writer):
+                self.users.pop(nick, None)
+            writer.close()
+
+    @staticmethod
+    def reply(writer, msg, **fields):
+        fields.update(op="reply", id=msg["id"])
+        writer.write(json.dumps(fields).encode() + b"\n")
+
+    def do_broadcast(self, writer, msg, line):
+        for other in self.workers:
+            if other is writer:
+                continue
+            if (other.transport.get_write_buffer_size() + len(line)
+                    > HUB_HIGH_WATER):
+                self.dropped += 1
+            else:
+                other.write(line)
+
+    def do_claim(self, writer, msg, line):
+        nick = msg["nick"]
+        ok = nick not in self.users
+        if ok:
+            self.users[nick] = writer
+            self.workers[writer].add(nick)
+        self.reply(writer, msg, ok=ok)
+
+    def do_release(self, writer, msg, line):
+        nick = msg["nick"]
+        if self.users.get(nick) is writer:
+            del self.users[nick]
+            self.workers[writer].discard(nick)
+
+    def do_users(self, writer, msg, line):
+        names = list(self.users)
+        for start in range(0, len(names), NAMES_PER_REPLY):
+            end = start + NAMES_PER_REPLY
+            self.reply(writer, msg, names=names[start:end],
+                       more=end < len(names))
+        if not names:
+            self.reply(writer, msg, names=[], more=False)
+
+
+class Relay:
+    """
+    A worker's connection to the hub. Like the hub, it drops broadcasts
+    rather than queue more than HUB_HIGH_WATER bytes for it.
+    """
+
+    def __init__(self, server, path):
+        self.server = server
+        self.path = path
+        self.ids = count()
+        self.pending = {}
+        self.partial = {}
+        self.dropped = 0
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_unix_connection(
+            self.path, limit=HUB_LIMIT)
+        self.closed = asyncio.create_task(self.listen())
+
+    def send(self, **msg):
+        self.writer.write(json.dumps(msg).encode() + b"\n")
+
+    def broadcast(self, room, line):
+        data = json.dumps({"op": "broadcast", "room": room,
+                           "line": line}).encode() + b"\n"
+        if (self.writer.transport.get_write_buffer_size() + len(data)
+                > HUB_HIGH_WATER):
+            self.dropped += 1
+        else:
+            self.writer.write(data)
+
+    async def request(self, **msg):
+        msg["id"] = next(self.ids)
+        future = self.pending[msg["id"]] = (
+            asyncio.get_running_loop().create_future())
+        self.send(**msg)
+        return await future
+
+    def reply(self, msg):
+        """
+        Collects the parts of a reply and completes its request.
+        """
+        parts = self.partial.setdefault(msg["id"], [])
+        parts.extend(msg.get("names", ()))
+        if msg.get("more"):
+            return
+        del self.partial[msg["id"]]
+        if "names" in msg:
+            msg["names"] = parts
+        future = self.pending.pop(msg["id"])
+        if not future.done():
+            future.set_result(msg)
+
+    async def listen(self):
+        try:
+            while True:
+                try:
+                    line = await self.reader.readline()
+                except ValueError:
+                    # Longer than HUB_LIMIT; the rest of it is skipped too
+                    continue
+                if not line:
+                    break
+                try:
+                    msg = json.loads(line)
+                    if msg["op"] == "reply":
+                        self.reply(msg)
+                    else:
+                        self.server.deliver(msg["room"], msg["line"])
+                except (ValueError, KeyError, TypeError):
+                    # Skip a bad message rather than stop the worker
+                    continue
+        except ConnectionError:
+            pass
+        finally:
+            for future in self.pending.values():
+                future.cancel()
+
+
+class ShardedLoginRoom(LoginRoom):
+    """
+    Checks nicks with the hub, so they stay unique across all workers.
+    """
+
+    def do_login(self, session, line):
+        name = line.strip()
+        if not name:
+            session.push("Please enter a name\r\n".encode())
+        else:
+            asyncio.create_task(self.login(session, name))
+
+    async def login(self, session, name):
+        relay = self.server.relay
+        if name in self.server.users or not (
+                await relay.request(op="claim", nick=name))["ok"]:
+            session.push(f'The name "{name}" is taken.\r\n'.encode())
+            session.push("Please try again.\r\n".encode())
+        elif session.closed or session.room is not self:
+            relay.send(op="release", nick=name)
+        else:
+            session.name = name
+            session.enter(self.server.main_room)
+
+
+class ShardedChatRoom(ChatRoom):
+    """
+    Also sends its broadcasts to the same room on the other workers.
+    """
+
+    def broadcast(self, line):
+        super().broadcast(line)
+        self.server.relay.broadcast(self.name, line)
+
+    def do_who(self, session, line):
+        asyncio.create_task(self.who(session))
+
+    async def who(self, session):
+        names = (await self.server.relay.request(op="users"))["names"]
+        session.push("The following are logged in:\r\n".encode())
+        for name in names:
+            session.push(f"{name}\r\n".encode())
+
+
+class ShardedLogoutRoom(LogoutRoom):
+    def add(self, session):
+        super().add(session)
+        if session.name is not None:
+            self.server.relay.send(op="release", nick=session.name)
+
+
+class ShardedChatServer(ChatServer):
+    """
+    One worker of a sharded server. All workers listen on the same port
+    with SO_REUSEPORT, so the kernel spreads the connections over them.
+    Rooms are local to a worker, but what is said in a room reaches its
+    members on every worker, and the look and rooms commands only see the
+    local worker.
+    """
+
+    login_room = ShardedLoginRoom
+    chat_room = ShardedChatRoom
+    logout_room = ShardedLogoutRoom
+    reuse_port = True
+
+    def __init__(self, port, name, hub_path, **kwargs):
+        super().__init__(port, name, **kwargs)
+        self.relay = Relay(self, hub_path)
+
+    def deliver(self, room, line):
+        """
+        Broadcasts a line from another worker to the local room, if any.
+        """
+        try:
+            room = self.rooms[room]
+        except KeyError:
+            return
+        ChatRoom.broadcast(room, line)
+
+    async def serve_forever(self):
+        await self.relay.connect()
+        serving = asyncio.create_task(super().serve_forever())
+        # Without the hub the worker cannot keep nicks unique, so it stops
+        # when the hub goes away.
+        await self.relay.closed
+        serving.cancel()
+
+
+def worker_main(port, name, hub_path):
+    try:
+        asyncio.run(ShardedChatServer(port, name, hub_path).serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+async def supervise(port, name, workers, hub_path):
+    hub = Hub()
+    server = await asyncio.start_unix_server(hub.handle, hub_path,
+                                             limit=HUB_LIMIT)
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=worker_main,
+                                 args=(port, name, hub_path), daemon=True)
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the chat server as several worker processes.")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--name", default=NAME)
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(),
+                        help="number of worker processes")
+    parser.add_argument("--hub", help="path of the hub's Unix socket")
+    args = parser.parse_args()
+
+    hub_path = args.hub or os.path.join(tempfile.mkdtemp(), "hub.sock")
+    try:
+        asyncio.run(supervise(args.port, args.name, args.workers, hub_path))
+    except KeyboardInterrupt:
+        print()
+    finally:
+        if os.path.exists(hub_path):
+            os.unlink(hub_path)
+
+
+if __name__ == "__main__":
+    main()
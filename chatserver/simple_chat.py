@@ -1,53 +1,58 @@
-from asyncore import dispatcher
-from asynchat import async_chat
-import socket
-import asyncore
+import asyncio
 
 PORT = 5005
 NAME = "TestChat"
 
 
-class ChatSession(async_chat):
+class ChatSession:
     """
     A class that takes care of a connection between the server and a single user.
     """
 
-    def __init__(self, server, sock):
-        super().__init__(sock)
+    def __init__(self, server, reader, writer):
         self.server = server
-        self.set_terminator(b"\r\n")
-        self.data = []
+        self.reader = reader
+        self.writer = writer
         self.push(f"Welcome to {self.server.name}\r\n".encode())
 
-    def collect_incoming_data(self, data):
-        self.data.append(data)
+    def push(self, data):
+        self.writer.write(data)
 
-    def found_terminator(self):
+    async def run(self):
+        try:
+            while True:
+                try:
+                    line = await self.reader.readuntil(b"\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                        ConnectionError):
+                    break
+                self.found_terminator(line[:-2])
+                await self.writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.handle_close()
+
+    def found_terminator(self, line):
         """
         If a terminator is found, that means that a full
         line has been read. Broadcast it to everyone.
         """
-        line = "".join(self.data)
-        self.data = []
-        self.server.broadcast(line)
+        self.server.broadcast(line.decode())
 
     def handle_close(self):
-        super().handle_close()
+        self.writer.close()
         self.server.disconnect(self)
 
 
-class ChatServer(dispatcher):
+class ChatServer:
     """
     A class that receives connections and spawns individual
     sessions. It also handles broadcasts to these sessions.
     """
 
     def __init__(self, port, name):
-        super().__init__()
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.set_reuse_addr()
-        self.bind(("", port))
-        self.listen(5)
+        self.port = port
         self.name = name
         self.sessions = []
 
@@ -58,14 +63,21 @@ class ChatServer(dispatcher):
         for session in self.sessions:
             session.push(f"{line}\r\n".encode())
 
-    def handle_accept(self):
-        conn, addr = self.accept()
-        self.sessions.append(ChatSession(self, conn))
+    async def handle_accept(self, reader, writer):
+        session = ChatSession(self, reader, writer)
+        self.sessions.append(session)
+        await session.run()
+
+    async def serve_forever(self):
+        server = await asyncio.start_server(self.handle_accept, port=self.port,
+                                            reuse_address=True)
+        async with server:
+            await server.serve_forever()
 
 
 if __name__ == "__main__":
     s = ChatServer(PORT, NAME)
     try:
-        asyncore.loop()
+        asyncio.run(s.serve_forever())
     except KeyboardInterrupt:
         print()
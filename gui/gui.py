@@ -1,5 +1,5 @@
 from xmlrpc.client import ServerProxy, Fault
-from server import Node, UNHANDLED
+from server import Node, PooledTransport, UNHANDLED
 from client import random_string
 from threading import Thread
 from time import sleep
@@ -33,7 +33,8 @@ class Client(tk.Frame):
         t.start()
         # Give the server a head start:
         sleep(HEAD_START)
-        self.server = ServerProxy(url)
+        # Fetching can take a while, so the calls never time out
+        self.server = ServerProxy(url, transport=PooledTransport(None))
         for line in open(urlfile):
             line = line.strip()
             self.server.hello(line)
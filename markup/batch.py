@@ -0,0 +1,142 @@
+import argparse
+import functools
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from cache import BlockCache, FileCache, config_key, digest, file_key
+from handlers import HtmlRenderer
+from markup import BasicTextParser
+from util import stream_blocks
+
+CACHE_DIR = ".markup-cache"
+
+
+def find_inputs(source, pattern="*.txt"):
+    """
+    Returns (root, paths) for a directory, which is searched recursively for
+    files matching pattern, or for a glob, whose matches are mirrored relative
+    to their common directory.
+    """
+    if os.path.isdir(source):
+        root = source
+        paths = glob.glob(os.path.join(glob.escape(source), "**", pattern),
+                          recursive=True)
+    else:
+        paths = glob.glob(source, recursive=True)
+        if not paths:
+            return source, []
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(p))
+                                   for p in paths])
+    return root, sorted(p for p in paths if os.path.isfile(p))
+
+
+def output_path(root, path, out_dir):
+    relative = os.path.relpath(os.path.abspath(path), os.path.abspath(root))
+    return os.path.join(out_dir, os.path.splitext(relative)[0] + ".html")
+
+
+def block_cache_path(out_dir, target):
+    return os.path.join(out_dir, CACHE_DIR, digest(target) + ".json")
+
+
+def make_parser(out, single_pass=False, max_block_size=None):
+    parser = BasicTextParser(HtmlRenderer(out), single_pass)
+    if max_block_size is not None:
+        parser.reader = functools.partial(
+            stream_blocks, max_block_size=max_block_size, use_mmap=True)
+    return parser
+
+
+def convert(path, target, single_pass=False, block_cache=None,
+            max_block_size=None):
+    """
+    Converts one file and returns the number of seconds it took. The rules
+    keep state between blocks, so every file gets a fresh parser. If
+    block_cache is a path, unchanged blocks are copied from that cache. If
+    max_block_size is given, the file is memory-mapped and longer blocks
+    are split.
+    """
+    start = time.perf_counter()
+    os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+    with open(path, encoding="utf-8") as src, \
+            open(target, "w", encoding="utf-8") as out:
+        parser = make_parser(out, single_pass, max_block_size)
+        if block_cache is None:
+            parser.parse(src)
+        else:
+            cache = BlockCache(block_cache)
+            cache.parse(parser, src)
+            cache.save()
+    return time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert many text files to HTML in parallel.")
+    parser.add_argument("source", help="a directory or a glob of input files")
+    parser.add_argument("out_dir", help="directory that mirrors the inputs")
+    parser.add_argument("--pattern", default="*.txt",
+                        help="file pattern used when source is a directory")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of worker processes")
+    parser.add_argument("--single-pass", action="store_true",
+                        help="run all filters in one scan per block")
+    parser.add_argument("--cache", action="store_true",
+                        help="skip unchanged files and reuse unchanged blocks")
+    parser.add_argument("--max-block-size", type=int, default=None,
+                        help="split blocks longer than this many bytes")
+    args = parser.parse_args(argv)
+
+    root, paths = find_inputs(args.source, args.pattern)
+    if not paths:
+        print(f"No input files found in {args.source}", file=sys.stderr)
+        return 1
+
+    file_cache = None
+    if args.cache:
+        file_cache = FileCache(os.path.join(args.out_dir, CACHE_DIR,
+                                            "files.json"))
+        config = config_key(make_parser(None, args.single_pass,
+                                        args.max_block_size))
+
+    failed = skipped = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(args.jobs) as executor:
+        futures = {}
+        for path in paths:
+            target = output_path(root, path, args.out_dir)
+            block_cache = key = None
+            if file_cache is not None:
+                key = file_key(path, config)
+                if file_cache.fresh(target, key):
+                    skipped += 1
+                    continue
+                block_cache = block_cache_path(args.out_dir, target)
+            future = executor.submit(convert, path, target, args.single_pass,
+                                     block_cache, args.max_block_size)
+            futures[future] = path, target, key
+        for future in as_completed(futures):
+            path, target, key = futures[future]
+            try:
+                seconds = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"FAILED  {path}: {e}", file=sys.stderr)
+            else:
+                print(f"{seconds:8.3f}s {path}")
+                if file_cache is not None:
+                    file_cache.update(target, key)
+
+    if file_cache is not None:
+        file_cache.save()
+
+    elapsed = time.perf_counter() - start
+    print(f"Converted {len(futures) - failed} of {len(paths)} files "
+          f"({skipped} unchanged) in {elapsed:.3f}s")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,181 @@
+import argparse
+import functools
+import io
+import json
+import os
+import platform
+import random
+import runpy
+import sys
+import time
+import tracemalloc
+from handlers import HtmlRenderer
+from markup import BasicTextParser
+from util import blocks, stream_blocks
+
+WORDS = ("spam eggs bacon sausage beans ham toast lobster truffle pate "
+         "brandy shallots aubergine tomato sauce canned meat online").split()
+
+
+def sentence(rng, shape):
+    words = rng.choices(WORDS, k=rng.randint(4, 12))
+    if rng.random() < shape["emphasis"]:
+        i = rng.randrange(len(words))
+        words[i] = f"*{words[i]}*"
+    if rng.random() < shape["urls"]:
+        words.append(f"(http://{rng.choice(WORDS)}.fu/{rng.choice(WORDS)})")
+    if rng.random() < shape["emails"]:
+        words.append(f"{rng.choice(WORDS)}@{rng.choice(WORDS)}.fu")
+    return " ".join(words).capitalize() + "."
+
+
+def paragraph(rng, shape):
+    text = " ".join(sentence(rng, shape) for _ in range(rng.randint(2, 6)))
+    lines, line = [], []
+    for word in text.split():
+        line.append(word)
+        if sum(len(w) + 1 for w in line) > 65:
+            lines.append(" ".join(line))
+            line = []
+    if line:
+        lines.append(" ".join(line))
+    return "\n".join(lines)
+
+
+def generate(size, lists=0.2, headings=0.1, emphasis=0.3, urls=0.1,
+             emails=0.05, seed=0):
+    """
+    Returns a synthetic document of about size characters. lists and
+    headings are the share of blocks that start a bullet list or are a
+    heading; emphasis, urls and emails are the chance that a sentence
+    contains one.
+    """
+    rng = random.Random(seed)
+    shape = {"emphasis": emphasis, "urls": urls, "emails": emails}
+    parts = ["Synthetic benchmark document"]
+    length = len(parts[0])
+    while length < size:
+        roll = rng.random()
+        if roll < lists:
+            new = [f"  - {sentence(rng, shape)}"
+                   for _ in range(rng.randint(2, 8))]
+        elif roll < lists + headings:
+            new = [sentence(rng, {"emphasis": 0, "urls": 0, "emails": 0})
+                   .rstrip(".")]
+        else:
+            new = [paragraph(rng, shape)]
+        parts.extend(new)
+        length += sum(len(p) + 2 for p in new)
+    return "\n\n".join(parts) + "\n"
+
+
+def run_simple_markup(text):
+    stdin, stdout = sys.stdin, sys.stdout
+    sys.stdin, sys.stdout = io.StringIO(text), io.StringIO()
+    try:
+        runpy.run_path(os.path.join(os.path.dirname(__file__),
+                                    "simple_markup.py"))
+    finally:
+        sys.stdin, sys.stdout = stdin, stdout
+
+
+def run_parser(text, single_pass=False):
+    parser = BasicTextParser(HtmlRenderer(io.StringIO()), single_pass)
+    parser.parse(io.StringIO(text))
+
+
+def run_stream(text, single_pass=False):
+    data = text.encode()
+    parser = BasicTextParser(HtmlRenderer(io.StringIO()), single_pass)
+    parser.reader = functools.partial(stream_blocks, max_block_size=1 << 20)
+    parser.parse(io.BytesIO(data))
+
+
+CASES = {
+    "simple_markup": run_simple_markup,
+    "basic": run_parser,
+    "basic_single_pass": functools.partial(run_parser, single_pass=True),
+    "basic_stream": run_stream,
+}
+
+
+def measure(func, text, repeat):
+    """
+    Returns the best wall time over repeat runs and the peak traced memory
+    of one extra run.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(text)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func(text)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Measure markup conversion throughput.")
+    parser.add_argument("--size", type=int, default=1 << 20,
+                        help="document size in characters")
+    parser.add_argument("--lists", type=float, default=0.2)
+    parser.add_argument("--headings", type=float, default=0.1)
+    parser.add_argument("--emphasis", type=float, default=0.3)
+    parser.add_argument("--urls", type=float, default=0.1)
+    parser.add_argument("--emails", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--case", action="append", choices=sorted(CASES),
+                        help="case to run (default: all)")
+    parser.add_argument("--json", metavar="FILE",
+                        help="also write the results as JSON to FILE")
+    args = parser.parse_args(argv)
+
+    text = generate(args.size, args.lists, args.headings, args.emphasis,
+                    args.urls, args.emails, args.seed)
+    megabytes = len(text.encode()) / 1e6
+    count = sum(1 for _ in blocks(io.StringIO(text)))
+
+    results = []
+    for name in args.case or CASES:
+        seconds, peak = measure(CASES[name], text, args.repeat)
+        results.append({
+            "case": name,
+            "seconds": seconds,
+            "blocks_per_second": count / seconds,
+            "mb_per_second": megabytes / seconds,
+            "peak_memory_bytes": peak,
+        })
+        print(f"{name:20} {seconds:8.4f}s {count / seconds:12.0f} blocks/s "
+              f"{megabytes / seconds:8.2f} MB/s {peak / 1e6:8.2f} MB peak")
+
+    if args.json:
+        report = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "corpus": {
+                "size": args.size,
+                "bytes": len(text.encode()),
+                "blocks": count,
+                "lists": args.lists,
+                "headings": args.headings,
+                "emphasis": args.emphasis,
+                "urls": args.urls,
+                "emails": args.emails,
+                "seed": args.seed,
+            },
+            "repeat": args.repeat,
+            "results": results,
+        }
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
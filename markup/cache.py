@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+
+
+def digest(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def reader_key(reader):
+    """
+    Describes a block reader, including the settings bound to it with
+    functools.partial, such as stream_blocks' max_block_size and policy.
+    """
+    keywords = getattr(reader, "keywords", None)
+    if keywords is None:
+        return reader.__qualname__
+    settings = ", ".join(f"{key}={value!r}"
+                         for key, value in sorted(keywords.items())
+                         if key != "use_mmap")
+    return f"{reader_key(reader.func)}({settings})"
+
+
+def config_key(parser):
+    """
+    Returns a hash of everything about a parser that affects its output:
+    the handler, the reader, the rules and the filters.
+    """
+    parts = [type(parser.handler).__name__, str(parser.single_pass),
+             reader_key(parser.reader)]
+    parts += [type(rule).__name__ for rule in parser.rules]
+    parts += [f"{pattern} {name}" for pattern, name in parser.patterns]
+    return digest(*parts)
+
+
+def file_key(path, config):
+    """
+    Returns a hash of the contents of a file combined with a parser config.
+    """
+    h = hashlib.sha256(config.encode())
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def load_json(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_json(path, data):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+class FileCache:
+    """
+    Remembers which key each output file was built from, so files whose
+    input and parser config are unchanged can be skipped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = load_json(path)
+
+    def fresh(self, target, key):
+        return self.entries.get(target) == key and os.path.exists(target)
+
+    def update(self, target, key):
+        self.entries[target] = key
+
+    def save(self):
+        save_json(self.path, self.entries)
+
+
+class BlockCache:
+    """
+    Caches the rendered output of single blocks. A block is looked up by its
+    text, the parser config and the state of the rules before it (for
+    instance whether a list is open), and a hit replays the output and
+    restores the rule state the block left behind. The handler must be a
+    StreamHandler. Only entries used by the latest parse are saved.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = load_json(path)
+        self.used = {}
+
+    def parse(self, parser, file):
+        handler = parser.handler
+        config = config_key(parser)
+        handler.start("document")
+
+        for block in parser.reader(file):
+            before = self.rule_state(parser.rules)
+            key = digest(config, json.dumps(before, sort_keys=True), block)
+            entry = self.entries.get(key)
+            if entry is None:
+                handler.captured = []
+                try:
+                    parser.parse_block(block)
+                    entry = ["".join(handler.captured),
+                             self.rule_state(parser.rules)]
+                finally:
+                    handler.captured = None
+            else:
+                handler.write(entry[0])
+                for rule, state in zip(parser.rules, entry[1]):
+                    vars(rule).clear()
+                    vars(rule).update(state)
+            self.used[key] = entry
+
+        handler.end("document")
+
+    @staticmethod
+    def rule_state(rules):
+        return [dict(vars(rule)) for rule in rules]
+
+    def save(self):
+        save_json(self.path, self.used)
@@ -0,0 +1,79 @@
+from heapq import heapify, heappop, heapreplace
+import re
+
+
+class FilterEngine:
+    """
+    Applies several filter patterns to a block in one merged scan. Each
+    pattern is searched for on its own, so it keeps the fast literal-prefix
+    search the regex engine gives it, and the sub_ method for it is looked
+    up once, when the engine is built, instead of once per match. The next
+    match of every pattern is kept in a heap, and the leftmost one is taken
+    each time; a match that overlaps one already taken is searched for
+    again from the end of that one.
+
+    The result is the same as scanning with an alternation of the patterns
+    in the order they were added: at a given position the first filter
+    wins, and unlike applying the filters one after another, a filter never
+    sees the output of another one. Matches of the empty string are
+    skipped.
+    """
+
+    def __init__(self, filters, handler):
+        self.filters = []
+        for pattern, name in filters:
+            method = getattr(handler, "sub_" + name, None)
+            if not callable(method):
+                method = None
+            self.filters.append((re.compile(pattern), name, method))
+
+    def matches(self, block):
+        """
+        Yields the index of the filter and the match for every match in the
+        block, from left to right.
+        """
+        heap = []
+        for index, (pattern, _, _) in enumerate(self.filters):
+            match = pattern.search(block)
+            if match is not None:
+                heap.append((match.start(), index, match))
+        heapify(heap)
+        pos = 0
+        while heap:
+            start, index, match = heap[0]
+            if start < pos or start == match.end():
+                # Overlaps the last match taken, or is empty
+                match = self.filters[index][0].search(
+                    block, max(pos, start + (start == match.end())))
+                if match is None:
+                    heappop(heap)
+                else:
+                    heapreplace(heap, (match.start(), index, match))
+                continue
+            yield index, match
+            pos = match.end()
+            match = self.filters[index][0].search(block, pos)
+            if match is None:
+                heappop(heap)
+            else:
+                heapreplace(heap, (match.start(), index, match))
+
+    def replace(self, index, match):
+        method = self.filters[index][2]
+        if method is not None:
+            result = method(match)
+            if result is not None:
+                return result
+        return match.group(0)
+
+    def apply(self, block):
+        parts = []
+        pos = 0
+        for index, match in self.matches(block):
+            parts.append(block[pos:match.start()])
+            parts.append(self.replace(index, match))
+            pos = match.end()
+        if not parts:
+            return block
+        parts.append(block[pos:])
+        return "".join(parts)
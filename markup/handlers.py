@@ -1,3 +1,6 @@
+import sys
+
+
 class Handler:
     def callback(self, prefix, name, *args):
         method = getattr(self, prefix + name, None)
@@ -21,54 +24,80 @@ class Handler:
         return substitution
 
 
-class HtmlRenderer(Handler):
-    @staticmethod
-    def start_document():
-        print("<html><head><title>...</title></head><body>")
+class StreamHandler(Handler):
+    """
+    A handler that writes its output to a stream. Output is collected in a
+    list and written in chunks of about buffer_size characters, and whatever
+    is left is flushed at the end of the document. If encoding is given, the
+    chunks are encoded and written as bytes, so out must be a binary stream.
 
-    @staticmethod
-    def end_document():
-        print("</body></html>")
+    While captured is a list, everything written is also appended to it.
+    """
 
-    @staticmethod
-    def start_paragraph():
-        print("<p>")
+    def __init__(self, out=None, buffer_size=64 * 1024, encoding=None):
+        self.out = sys.stdout if out is None else out
+        self.buffer_size = buffer_size
+        self.encoding = encoding
+        self.buffer = []
+        self.buffered = 0
+        self.captured = None
 
-    @staticmethod
-    def end_paragraph():
-        print("</p>")
+    def write(self, text):
+        if self.captured is not None:
+            self.captured.append(text)
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered >= self.buffer_size:
+            self.flush()
 
-    @staticmethod
-    def start_heading():
-        print("<h2>")
+    def flush(self):
+        if not self.buffer:
+            return
+        chunk = "".join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        if self.encoding is not None:
+            chunk = chunk.encode(self.encoding)
+        self.out.write(chunk)
 
-    @staticmethod
-    def end_heading():
-        print("</h2>")
 
-    @staticmethod
-    def start_list():
-        print("<ul>")
+class HtmlRenderer(StreamHandler):
+    def start_document(self):
+        self.write("<html><head><title>...</title></head><body>\n")
 
-    @staticmethod
-    def end_list():
-        print("</ul>")
+    def end_document(self):
+        self.write("</body></html>\n")
+        self.flush()
 
-    @staticmethod
-    def start_listitem():
-        print("<li>")
+    def start_paragraph(self):
+        self.write("<p>\n")
 
-    @staticmethod
-    def end_listitem():
-        print("</li>")
+    def end_paragraph(self):
+        self.write("</p>\n")
 
-    @staticmethod
-    def start_title():
-        print("<h1>")
+    def start_heading(self):
+        self.write("<h2>\n")
 
-    @staticmethod
-    def end_title():
-        print("</h1>")
+    def end_heading(self):
+        self.write("</h2>\n")
+
+    def start_list(self):
+        self.write("<ul>\n")
+
+    def end_list(self):
+        self.write("</ul>\n")
+
+    def start_listitem(self):
+        self.write("<li>\n")
+
+    def end_listitem(self):
+        self.write("</li>\n")
+
+    def start_title(self):
+        self.write("<h1>\n")
+
+    def end_title(self):
+        self.write("</h1>\n")
 
     @staticmethod
     def sub_emphasis(match):
@@ -82,6 +111,40 @@ class HtmlRenderer(Handler):
     def sub_mail(match):
         return '<a href="mailto:{}">{}</a>'.format(match.group(1), match.group(1))
 
+    def feed(self, data):
+        self.write(data + "\n")
+
+
+class TextRenderer(StreamHandler):
+    """
+    Renders plain text: titles and headings are underlined, list items are
+    bulleted and the inline markup is dropped.
+    """
+
+    last = ""
+
+    def end_document(self):
+        self.flush()
+
+    def end_paragraph(self):
+        self.write("\n")
+
+    def end_heading(self):
+        self.write("-" * len(self.last) + "\n\n")
+
+    def end_list(self):
+        self.write("\n")
+
+    def start_listitem(self):
+        self.write("  * ")
+
+    def end_title(self):
+        self.write("=" * len(self.last) + "\n\n")
+
     @staticmethod
-    def feed(data):
-        print(data)
+    def sub_emphasis(match):
+        return match.group(1)
+
+    def feed(self, data):
+        self.last = data
+        self.write(data + "\n")
@@ -0,0 +1,123 @@
+import json
+import re
+import sys
+from time import perf_counter
+from filters import FilterEngine
+
+
+class Stats:
+    __slots__ = ("calls", "seconds", "bytes")
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def to_dict(self):
+        return {"calls": self.calls, "seconds": self.seconds,
+                "bytes": self.bytes}
+
+
+class Profiler:
+    """
+    Records call counts, cumulative time and matched bytes for every rule
+    condition, rule action and filter a Parser runs. For a condition the
+    bytes are those of the blocks it accepted, for a filter those of the
+    text it matched. In single-pass mode the whole scan is timed as one
+    entry, and for each filter the calls are its matches and the time is
+    that spent replacing them.
+
+    When the document ends, the report is printed to out (stderr by
+    default) sorted by time, or written as JSON to json_path if given.
+    """
+
+    def __init__(self, out=None, json_path=None):
+        self.out = sys.stderr if out is None else out
+        self.json_path = json_path
+        self.stats = {}
+
+    def entry(self, key):
+        try:
+            return self.stats[key]
+        except KeyError:
+            stats = self.stats[key] = Stats()
+            return stats
+
+    def add(self, key, seconds, size):
+        stats = self.entry(key)
+        stats.calls += 1
+        stats.seconds += seconds
+        stats.bytes += size
+
+    def filter(self, parser, block):
+        handler = parser.handler
+        if parser.single_pass:
+            if parser.engine is None:
+                parser.engine = FilterEngine(parser.patterns, handler)
+            engine = parser.engine
+            parts = []
+            pos = 0
+            scan = perf_counter()
+            for index, match in engine.matches(block):
+                start = perf_counter()
+                parts.append(block[pos:match.start()])
+                parts.append(engine.replace(index, match))
+                pos = match.end()
+                self.add("filter " + engine.filters[index][1],
+                         perf_counter() - start, pos - match.start())
+            parts.append(block[pos:])
+            self.add("filter scan", perf_counter() - scan, 0)
+            return "".join(parts)
+
+        for pattern, name in parser.patterns:
+            stats = self.entry("filter " + name)
+            sub = handler.sub(name)
+
+            def substitution(match, stats=stats, sub=sub):
+                stats.bytes += match.end() - match.start()
+                return sub(match)
+
+            start = perf_counter()
+            block = re.sub(pattern, substitution, block)
+            stats.seconds += perf_counter() - start
+            stats.calls += 1
+        return block
+
+    def apply_rules(self, rules, block, handler, source=None):
+        if source is None:
+            source = block
+        for rule in rules:
+            name = type(rule).__name__
+            start = perf_counter()
+            accepted = rule.condition(block)
+            self.add(name + ".condition", perf_counter() - start,
+                     len(block) if accepted else 0)
+            if accepted:
+                start = perf_counter()
+                last = rule.action(source, handler)
+                self.add(name + ".action", perf_counter() - start,
+                         len(source))
+                if last:
+                    break
+
+    def rows(self):
+        return sorted(self.stats.items(), key=lambda item: item[1].seconds,
+                      reverse=True)
+
+    def report(self):
+        print(f"{'name':32} {'calls':>10} {'seconds':>10} {'bytes':>12}",
+              file=self.out)
+        for key, stats in self.rows():
+            print(f"{key:32} {stats.calls:10} {stats.seconds:10.4f} "
+                  f"{stats.bytes:12}", file=self.out)
+
+    def to_json(self, **kwargs):
+        return json.dumps({key: stats.to_dict() for key, stats in self.rows()},
+                          **kwargs)
+
+    def finish(self):
+        if self.json_path is None:
+            self.report()
+        else:
+            with open(self.json_path, "w", encoding="utf-8") as f:
+                f.write(self.to_json(indent=2))
@@ -1,43 +1,136 @@
+import io
 import sys
 import re
 from handlers import HtmlRenderer
 from util import blocks
-from rules import ListRule, ListItemRule, TitleRule, HeadingRule, ParagraphRule
+from filters import FilterEngine
+from instrument import Profiler
+from nodes import TreeBuilder
+from rules import (ListRule, ListItemRule, TitleRule, HeadingRule,
+                   ParagraphRule, RuleIndex)
 
 
 class Parser:
-    def __init__(self, handler):
+    """
+    Reads blocks from a file, runs the filters over each block and hands it
+    to the first rule that takes it.
+
+    With single_pass=True, the filters are merged into one FilterEngine,
+    which replaces all their matches in one pass over each block instead of
+    rebuilding the block once per filter. Rules are looked up through a
+    RuleIndex, so only those whose predicates admit a block are tried, still
+    in the order they were added.
+
+    The reader turns the file into blocks; it can be replaced with, say, a
+    partial of util.stream_blocks to bound the memory used per block.
+
+    If a Profiler is given, every rule and filter call goes through it and
+    its report is produced when the document ends.
+    """
+
+    def __init__(self, handler, single_pass=False, profiler=None):
         self.handler = handler
+        self.single_pass = single_pass
+        self.profiler = profiler
         self.rules = []
         self.filters = []
+        self.patterns = []
+        self.engine = None
+        self.index = None
+        self.reader = blocks
 
     def add_rule(self, rule):
         self.rules.append(rule)
+        self.index = None
 
     def add_filter(self, pattern, name):
         def filter(block, handler):
             return re.sub(pattern, handler.sub(name), block)
 
         self.filters.append(filter)
+        self.patterns.append((pattern, name))
+        self.engine = None
+
+    def reset(self):
+        """
+        Clears the state the rules keep between blocks, so the parser can be
+        reused for another document.
+        """
+        for rule in self.rules:
+            rule.reset()
+
+    def filter(self, block):
+        if self.profiler is not None:
+            return self.profiler.filter(self, block)
+
+        if self.single_pass:
+            if self.engine is None:
+                self.engine = FilterEngine(self.patterns, self.handler)
+            return self.engine.apply(block)
+
+        for filter in self.filters:
+            block = filter(block, self.handler)
+        return block
 
     def parse(self, file):
         self.handler.start("document")
 
-        for block in blocks(file):
-            for filter in self.filters:
-                block = filter(block, self.handler)
-            for rule in self.rules:
-                if rule.condition(block):
-                    last = rule.action(block, self.handler)
-                    if last:
-                        break
+        for block in self.reader(file):
+            self.parse_block(block)
 
         self.handler.end("document")
+        if self.profiler is not None:
+            self.profiler.finish()
+
+    def build(self, file):
+        """
+        Parses file into a tree of Nodes instead of calling the handler, with
+        the filter matches as inline Spans. As in parse(), the rules decide
+        on each block as filtered for HTML, so every format rendered from
+        the tree gets the structure parse() gives an HtmlRenderer; the rule
+        actions then get the unfiltered block.
+        """
+        builder = TreeBuilder(self.patterns)
+        handler = self.handler
+        self.handler = HtmlRenderer(io.StringIO())
+        self.engine = None
+        try:
+            for block in self.reader(file):
+                self.apply_rules(self.filter(block), block, builder)
+        finally:
+            self.handler = handler
+            self.engine = None
+        return builder.document
+
+    def parse_block(self, block):
+        self.apply_rules(self.filter(block))
+
+    def apply_rules(self, block, source=None, handler=None):
+        """
+        Hands the block to the rules that take it. If source is given, the
+        rules decide on block but their actions get source, and they call
+        handler instead of the parser's.
+        """
+        if source is None:
+            source = block
+        if handler is None:
+            handler = self.handler
+        if self.index is None:
+            self.index = RuleIndex(self.rules)
+        if self.profiler is not None:
+            self.profiler.apply_rules(self.index.candidates(block), block,
+                                      handler, source)
+            return
+        for rule in self.index.candidates(block):
+            if rule.condition(block):
+                last = rule.action(source, handler)
+                if last:
+                    break
 
 
 class BasicTextParser(Parser):
-    def __init__(self, handler):
-        Parser.__init__(self, handler)
+    def __init__(self, handler, single_pass=False, profiler=None):
+        Parser.__init__(self, handler, single_pass, profiler)
         self.add_rule(ListRule())
         self.add_rule(ListItemRule())
         self.add_rule(TitleRule())
@@ -50,7 +143,10 @@ class BasicTextParser(Parser):
 
 
 if __name__ == "__main__":
+    profiler = None
+    if "--profile" in sys.argv[1:]:
+        profiler = Profiler()
     handler = HtmlRenderer()
-    parser = BasicTextParser(handler)
+    parser = BasicTextParser(handler, profiler=profiler)
 
     parser.parse(sys.stdin)
@@ -0,0 +1,124 @@
+import json
+from filters import FilterEngine
+from handlers import Handler
+
+
+class Span:
+    """
+    A run of inline text. type is "text" for plain text or the name of the
+    filter that matched it, source is the matched text and text is its first
+    group. A Span can stand in for a match object in a sub_ method.
+    """
+
+    __slots__ = ("type", "text", "source")
+
+    def __init__(self, type, text, source=None):
+        self.type = type
+        self.text = text
+        self.source = text if source is None else source
+
+    def group(self, index=0):
+        return self.source if index == 0 else self.text
+
+    def to_dict(self):
+        return {"type": self.type, "text": self.text}
+
+
+class Node:
+    """
+    A block-level node: the document, a list, or a title, heading, list
+    item or paragraph, whose children are Spans.
+    """
+
+    __slots__ = ("type", "children")
+
+    def __init__(self, type, children=None):
+        self.type = type
+        self.children = [] if children is None else children
+
+    def to_dict(self):
+        return {"type": self.type,
+                "children": [child.to_dict() for child in self.children]}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+
+class TreeBuilder(Handler):
+    """
+    A handler that builds a Node tree from the rule events and splits the
+    text it is fed into Spans with the parser's filter patterns.
+    """
+
+    def __init__(self, patterns):
+        self.engine = FilterEngine(patterns, self)
+        self.document = Node("document")
+        self.stack = [self.document]
+
+    def start(self, name):
+        node = Node(name)
+        self.stack[-1].children.append(node)
+        self.stack.append(node)
+
+    def end(self, name):
+        while len(self.stack) > 1:
+            if self.stack.pop().type == name:
+                break
+
+    def feed(self, data):
+        # Empty text still becomes a Span, so it is fed to the handlers
+        self.stack[-1].children.extend(self.spans(data)
+                                       or [Span("text", data)])
+
+    def spans(self, text):
+        result = []
+        pos = 0
+        for index, match in self.engine.matches(text):
+            if match.start() > pos:
+                result.append(Span("text", text[pos:match.start()]))
+            name = self.engine.filters[index][1]
+            inner = match.group(1) if match.re.groups else match.group(0)
+            result.append(Span(name, inner, match.group(0)))
+            pos = match.end()
+        if pos < len(text):
+            result.append(Span("text", text[pos:]))
+        return result
+
+
+def render(document, handlers):
+    """
+    Walks the tree once and replays it to every handler, passing each of
+    them the inline text as rendered by its own sub_ methods.
+    """
+    subs = [{} for _ in handlers]
+
+    def inline(index, handler, spans):
+        parts = []
+        for span in spans:
+            if span.type == "text":
+                parts.append(span.text)
+                continue
+            try:
+                method = subs[index][span.type]
+            except KeyError:
+                method = getattr(handler, "sub_" + span.type, None)
+                if not callable(method):
+                    method = None
+                subs[index][span.type] = method
+            result = method(span) if method is not None else None
+            parts.append(span.source if result is None else result)
+        return "".join(parts)
+
+    def walk(node):
+        for handler in handlers:
+            handler.start(node.type)
+        if node.children and isinstance(node.children[0], Span):
+            for index, handler in enumerate(handlers):
+                handler.feed(inline(index, handler, node.children))
+        else:
+            for child in node.children:
+                walk(child)
+        for handler in handlers:
+            handler.end(node.type)
+
+    walk(document)
@@ -0,0 +1,40 @@
+import argparse
+import sys
+from handlers import HtmlRenderer, TextRenderer
+from markup import BasicTextParser
+from nodes import render
+
+RENDERERS = {"html": HtmlRenderer, "txt": TextRenderer}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Parse a text file once and write it in several formats.")
+    parser.add_argument("input", help="the text file to convert")
+    parser.add_argument("output", help="output path without extension")
+    parser.add_argument("--format", action="append",
+                        choices=sorted(RENDERERS) + ["json"],
+                        help="format to write (default: all)")
+    args = parser.parse_args(argv)
+    formats = args.format or sorted(RENDERERS) + ["json"]
+
+    with open(args.input, encoding="utf-8") as f:
+        document = BasicTextParser(None).build(f)
+
+    files = [open(f"{args.output}.{name}", "w", encoding="utf-8")
+             for name in formats]
+    try:
+        handlers = []
+        for name, out in zip(formats, files):
+            if name == "json":
+                out.write(document.to_json(indent=1))
+            else:
+                handlers.append(RENDERERS[name](out))
+        render(document, handlers)
+    finally:
+        for out in files:
+            out.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,18 @@
+from bisect import bisect_left
+from typing import Optional
+
+
 class Rule:
+    """
+    The cheap predicates below let the parser skip a rule without calling
+    its condition: the block must start with one of first_chars, be a single
+    line if single_line is set, and be at most max_length characters long.
+    """
+
     type: str
+    first_chars: Optional[str] = None
+    single_line: bool = False
+    max_length: Optional[int] = None
 
     def action(self, block, handler):
         handler.start(self.type)
@@ -7,9 +20,14 @@ class Rule:
         handler.end(self.type)
         return True
 
+    def reset(self):
+        pass
+
 
 class HeadingRule(Rule):
     type: str = "heading"
+    single_line: bool = True
+    max_length: Optional[int] = 70
 
     @staticmethod
     def condition(block):
@@ -19,6 +37,10 @@ class HeadingRule(Rule):
 class TitleRule(HeadingRule):
     type: str = "title"
     first: bool = True
+    # The rule has to see the first block it is offered, even one that is
+    # not a heading, so it must not be skipped.
+    single_line: bool = False
+    max_length: Optional[int] = None
 
     def condition(self, block):
         if not self.first:
@@ -27,9 +49,13 @@ class TitleRule(HeadingRule):
 
         return HeadingRule.condition(block)
 
+    def reset(self):
+        self.first = True
+
 
 class ListItemRule(Rule):
     type: str = "listitem"
+    first_chars: Optional[str] = "-"
 
     @staticmethod
     def condition(block):
@@ -45,13 +71,14 @@ class ListItemRule(Rule):
 class ListRule(ListItemRule):
     type: str = "list"
     inside: bool = False
+    first_chars: Optional[str] = None
 
     @staticmethod
-    def condition():
+    def condition(block):
         return True
 
     def action(self, block, handler):
-        if not self.inside and ListItemRule.condition(self, block):
+        if not self.inside and ListItemRule.condition(block):
             handler.start(self.type)
             self.inside = True
         elif self.inside and not ListItemRule.condition(block):
@@ -60,10 +87,45 @@ class ListRule(ListItemRule):
 
         return False
 
+    def reset(self):
+        self.inside = False
+
 
 class ParagraphRule(Rule):
     type: str = "paragraph"
 
     @staticmethod
-    def condition():
+    def condition(block):
         return True
+
+
+class RuleIndex:
+    """
+    Classifies a block by its first character, whether it spans several
+    lines and its length, and returns the rules whose predicates admit it,
+    in their original order. The list is cached per class of block.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.lengths = sorted({rule.max_length for rule in rules
+                               if rule.max_length is not None})
+        self.cache = {}
+
+    def candidates(self, block):
+        key = (block[:1], "\n" in block,
+               bisect_left(self.lengths, len(block)))
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+
+        first, multiline, length = key
+        rules = tuple(
+            rule for rule in self.rules
+            if (rule.first_chars is None or first in rule.first_chars)
+            and not (rule.single_line and multiline)
+            and (rule.max_length is None
+                 or bisect_left(self.lengths, rule.max_length) >= length))
+        self.cache[key] = rules
+        return rules
@@ -0,0 +1,183 @@
+import argparse
+import io
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from handlers import HtmlRenderer
+from markup import BasicTextParser
+
+PORT = 8000
+MAX_BODY = 16 * 1024 * 1024
+LATENCY_SAMPLES = 1000
+
+worker_parser = None
+
+
+def warm_up(single_pass):
+    """
+    Builds the parser a worker process keeps for all its conversions.
+    """
+    global worker_parser
+    worker_parser = BasicTextParser(HtmlRenderer(io.StringIO()), single_pass)
+    worker_parser.parse(io.StringIO("Warm up\n\n*a* http://a.b a@b.c\n"))
+
+
+def convert(text):
+    worker_parser.reset()
+    # Drop whatever a failed conversion left buffered before swapping out
+    handler = worker_parser.handler
+    handler.buffer = []
+    handler.buffered = 0
+    handler.out = out = io.StringIO()
+    worker_parser.parse(io.StringIO(text))
+    return out.getvalue()
+
+
+class Metrics:
+    """
+    Counts requests and keeps the latest latencies for percentiles.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+        self.bytes_in = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def record(self, seconds, size):
+        with self.lock:
+            self.requests += 1
+            self.bytes_in += size
+            self.latencies.append(seconds)
+
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def report(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            report = {"requests": self.requests, "errors": self.errors,
+                      "rejected": self.rejected, "bytes_in": self.bytes_in}
+        for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+            index = min(int(q * len(latencies)), len(latencies) - 1)
+            report[f"latency_{name}"] = latencies[index] if latencies else None
+        if latencies:
+            report["latency_mean"] = sum(latencies) / len(latencies)
+        return report
+
+
+class ConversionHandler(BaseHTTPRequestHandler):
+    """
+    POST text to any path to get HTML back; GET /metrics for statistics.
+    """
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        self.reply(200, json.dumps(self.server.metrics.report()).encode(),
+                   "application/json")
+
+    def do_POST(self):
+        server = self.server
+        length = self.headers.get("Content-Length")
+        if length is None:
+            server.metrics.count("rejected")
+            self.send_error(411)
+            return
+        if not (length.isascii() and length.isdigit()):
+            server.metrics.count("rejected")
+            self.send_error(400, "Bad Content-Length")
+            return
+        length = int(length)
+        if length > server.max_body:
+            server.metrics.count("rejected")
+            self.send_error(413)
+            return
+        if not server.slots.acquire(blocking=False):
+            server.metrics.count("rejected")
+            self.send_error(503, "Too many conversions in progress")
+            return
+        try:
+            start = time.perf_counter()
+            text = self.rfile.read(length).decode("utf-8")
+            html = server.pool.submit(convert, text).result()
+        except Exception as e:
+            server.metrics.count("errors")
+            self.send_error(500, str(e))
+            return
+        finally:
+            server.slots.release()
+        server.metrics.record(time.perf_counter() - start, length)
+        self.reply(200, html.encode("utf-8"), "text/html; charset=utf-8")
+
+    def reply(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class ConversionServer(ThreadingHTTPServer):
+    """
+    An HTTP server that hands conversions to a pool of worker processes,
+    each with a warm BasicTextParser. At most max_pending conversions run
+    or wait at a time; further requests get 503 at once.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, workers=None, max_pending=64,
+                 max_body=MAX_BODY, single_pass=False, verbose=False):
+        super().__init__(address, ConversionHandler)
+        self.pool = ProcessPoolExecutor(workers, initializer=warm_up,
+                                        initargs=(single_pass,))
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.max_body = max_body
+        self.metrics = Metrics()
+        self.verbose = verbose
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serve markup conversions over HTTP.")
+    parser.add_argument("--host", default="")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="number of worker processes")
+    parser.add_argument("--max-pending", type=int, default=64,
+                        help="conversions allowed in flight at once")
+    parser.add_argument("--single-pass", action="store_true",
+                        help="run all filters in one scan per block")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="log every request")
+    args = parser.parse_args(argv)
+
+    server = ConversionServer((args.host, args.port), args.workers,
+                              args.max_pending, single_pass=args.single_pass,
+                              verbose=args.verbose)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print()
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
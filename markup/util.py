@@ -1,3 +1,10 @@
+import io
+import mmap
+import os
+import re
+import stat
+
+
 def lines(file):
     for line in file:
         yield line
@@ -13,3 +20,122 @@ def blocks(file):
             yield "".join(block).strip()
 
             block = []
+
+
+BLANK_LINE = re.compile(rb"\n[ \t\r\f\v]*\n")
+
+
+def map_file(file):
+    """
+    Memory-maps a regular, non-empty file for reading, or returns None if
+    the file cannot be mapped.
+    """
+    try:
+        fileno = file.fileno()
+        info = os.fstat(fileno)
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+    if not stat.S_ISREG(info.st_mode) or info.st_size == 0:
+        return None
+    return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+
+
+def pieces(data, start, end, limit, policy):
+    """
+    Yields (start, end) pairs that cover data[start:end] with pieces of at
+    most limit bytes, cut after a newline where possible and never inside a
+    UTF-8 character. With the "error" policy an oversized block raises
+    ValueError instead.
+    """
+    while limit is not None and end - start > limit:
+        if policy != "split":
+            raise ValueError(f"Block is larger than {limit} bytes")
+        cut = data.rfind(b"\n", start, start + limit) + 1
+        if cut <= start:
+            cut = start + limit
+            while cut > start + 1 and data[cut] & 0xC0 == 0x80:
+                cut -= 1
+        yield start, cut
+        start = cut
+    yield start, end
+
+
+def decode(data, start, end, encoding):
+    chunk = bytes(data[start:end])
+    if b"\r" in chunk:
+        chunk = chunk.replace(b"\r\n", b"\n")
+    return chunk.decode(encoding).strip()
+
+
+def stream_blocks(file, chunk_size=1 << 20, max_block_size=None,
+                  policy="split", encoding="utf-8", use_mmap=False):
+    """
+    Yields the same blocks as blocks(), but reads the file in binary chunks
+    of chunk_size bytes and finds the blank lines between blocks with a
+    regular expression over the raw bytes. A text file is read through its
+    underlying binary buffer.
+
+    Blocks longer than max_block_size bytes are split into several blocks
+    (or rejected with ValueError if policy is "error"), so at most about
+    max_block_size + chunk_size bytes are held at a time. With use_mmap, a
+    regular file is memory-mapped and scanned without being copied.
+    """
+    raw = getattr(file, "buffer", file)
+    data = map_file(raw) if use_mmap else None
+    if data is not None:
+        with data:
+            start = pos = 0
+            while True:
+                match = BLANK_LINE.search(data, pos)
+                end = match.start() if match else len(data)
+                for a, b in pieces(data, start, end, max_block_size, policy):
+                    block = decode(data, a, b, encoding)
+                    if block:
+                        yield block
+                if not match:
+                    return
+                start = match.end()
+                pos = start - 1
+        return
+
+    buf = bytearray()
+    start = pos = 0
+    eof = False
+    while True:
+        match = BLANK_LINE.search(buf, pos)
+        if match:
+            for a, b in pieces(buf, start, match.start(), max_block_size,
+                               policy):
+                block = decode(buf, a, b, encoding)
+                if block:
+                    yield block
+            start = match.end()
+            pos = start - 1
+            continue
+
+        if eof:
+            for a, b in pieces(buf, start, len(buf), max_block_size, policy):
+                block = decode(buf, a, b, encoding)
+                if block:
+                    yield block
+            return
+
+        if max_block_size is not None and len(buf) - start > max_block_size:
+            *full, last = pieces(buf, start, len(buf), max_block_size, policy)
+            for a, b in full:
+                block = decode(buf, a, b, encoding)
+                if block:
+                    yield block
+            start = last[0]
+
+        del buf[:start]
+        pos = max(pos - start, 0)
+        start = 0
+        newline = buf.rfind(b"\n", pos)
+        pos = newline if newline >= 0 else len(buf)
+
+        chunk = raw.read(chunk_size)
+        if chunk:
+            buf += chunk
+        else:
+            eof = True
@@ -2,7 +2,7 @@ from xmlrpc.client import ServerProxy, Fault
 from cmd import Cmd
 from random import choice
 from string import ascii_lowercase
-from server import Node, UNHANDLED
+from server import Node, PooledTransport, UNHANDLED
 from threading import Thread
 from time import sleep
 import sys
@@ -44,7 +44,8 @@ class Client(Cmd):
         t.start()
         # Give the server a head start:
         sleep(HEAD_START)
-        self.server = ServerProxy(url)
+        # Fetching can take a while, so the calls never time out
+        self.server = ServerProxy(url, transport=PooledTransport(None))
         for line in open(urlfile):
             line = line.strip()
             self.server.hello(line)
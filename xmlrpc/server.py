@@ -1,12 +1,36 @@
-from xmlrpc.client import ServerProxy, Fault
+from xmlrpc.client import ServerProxy, Fault, Transport, ProtocolError, Binary
+from http.client import HTTPConnection
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from os.path import join, abspath, isfile
-from xmlrpc.server import SimpleXMLRPCServer
+from tempfile import mkstemp
+import os
+import selectors
+import socket
+from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+from socketserver import ThreadingMixIn
+from threading import BoundedSemaphore, Lock, Thread
+from time import monotonic
+from copy import copy
 from urllib.parse import urlparse
 import sys
 
 SimpleXMLRPCServer.allow_reuse_address = 1
 
 MAX_HISTORY_LENGTH = 6
+TIMEOUT = 10  # Seconds to wait for each peer
+HOP_FACTOR = 0.5  # Share of its own timeout a Node gives the next hop
+MAX_FAILURES = 3  # Failures in a row before a peer is forgotten
+MAX_WORKERS = 32  # Peers asked at once
+SERVER_WORKERS = 16  # Requests handled at once
+REQUEST_TIMEOUT = 30  # Seconds a client may take to send its request
+KEEP_ALIVE = 15  # Seconds the server keeps an idle connection open
+IDLE_TIMEOUT = 10  # Seconds a client keeps an idle connection
+POOL_SIZE = 4  # Idle connections kept per peer
+CHUNK_SIZE = 1024 * 1024  # Bytes sent per read call
+CACHE_SIZE = 1024  # Lookups remembered
+HIT_TTL = 300  # Seconds to remember which Node had a file
+MISS_TTL = 10  # Seconds to remember that no Node had a file
 
 UNHANDLED = 100
 ACCESS_DENIED = 200
@@ -49,16 +73,332 @@ def get_port(url):
     return int(parts[-1])
 
 
+class LookupCache:
+    """
+    A bounded LRU cache whose entries expire after their own TTLs.
+    """
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value, expires = self.entries[key]
+            except KeyError:
+                return None
+            if expires < monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = value, monotonic() + ttl
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class Health:
+    __slots__ = ("requests", "failures", "consecutive", "last_error")
+
+    def __init__(self):
+        self.requests = 0
+        self.failures = 0
+        self.consecutive = 0
+        self.last_error = None
+
+    def to_dict(self):
+        return {"requests": self.requests, "failures": self.failures,
+                "consecutive": self.consecutive,
+                "last_error": self.last_error}
+
+
+class PooledTransport(Transport):
+    """
+    A transport that keeps up to size idle keep-alive connections to each
+    peer and can be shared by any number of threads and ServerProxies.
+    Connections idle for longer than idle_timeout are closed. After a
+    failed request the peer's idle connections are closed as well, since
+    they are likely to be dead too. Connections give up after timeout
+    seconds, or never if timeout is None.
+    """
+
+    def __init__(self, timeout=TIMEOUT, size=POOL_SIZE,
+                 idle_timeout=IDLE_TIMEOUT):
+        super().__init__()
+        self.timeout = timeout
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.lock = Lock()
+        self.idle = {}
+        self.health = {}
+
+    def make_connection(self, host):
+        with self.lock:
+            self.prune()
+            idle = self.idle.get(host)
+            if idle:
+                conn = idle.pop()[0]
+                conn.timeout = self.timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(self.timeout)
+                return conn
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        return HTTPConnection(chost, timeout=self.timeout)
+
+    def with_timeout(self, timeout):
+        """
+        Returns a transport that shares this one's connections and health
+        records but uses another timeout.
+        """
+        other = copy(self)
+        other.timeout = timeout
+        return other
+
+    def failures(self, host):
+        """
+        Returns the number of requests in a row to host that have failed.
+        """
+        with self.lock:
+            health = self.health.get(host)
+            return 0 if health is None else health.consecutive
+
+    def prune(self):
+        """
+        Closes the connections that have been idle for too long.
+        """
+        limit = monotonic() - self.idle_timeout
+        for idle in self.idle.values():
+            while idle and idle[0][1] < limit:
+                idle.popleft()[0].close()
+
+    def release(self, host, conn):
+        with self.lock:
+            idle = self.idle.setdefault(host, deque())
+            if len(idle) < self.size:
+                idle.append((conn, monotonic()))
+                return
+        conn.close()
+
+    def discard(self, host):
+        with self.lock:
+            idle = self.idle.pop(host, ())
+        for conn, used in idle:
+            conn.close()
+
+    def single_request(self, host, handler, request_body, verbose=False):
+        with self.lock:
+            health = self.health.setdefault(host, Health())
+            health.requests += 1
+        conn = None
+        try:
+            conn = self.send_request(host, handler, request_body, verbose)
+            resp = conn.getresponse()
+            if resp.status != 200:
+                raise ProtocolError(host + handler, resp.status, resp.reason,
+                                    dict(resp.getheaders()))
+            self.verbose = verbose
+            result = self.parse_response(resp)
+        except Fault:
+            # The whole response has been read, so the connection is fine
+            health.consecutive = 0
+            self.release(host, conn)
+            raise
+        except Exception as e:
+            health.failures += 1
+            health.consecutive += 1
+            health.last_error = repr(e)
+            if conn is not None:
+                conn.close()
+            self.discard(host)
+            raise
+        health.consecutive = 0
+        self.release(host, conn)
+        return result
+
+    def stats(self):
+        """
+        Returns the request and failure counts for every peer.
+        """
+        with self.lock:
+            return {host: health.to_dict()
+                    for host, health in self.health.items()}
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for conn, used in connections:
+                conn.close()
+
+
+class RequestHandler(SimpleXMLRPCRequestHandler):
+    """
+    Handles a single request on a connection that may be kept open, and
+    gives up on clients that are too slow to send it.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        self.timeout = self.server.request_timeout
+        super().setup()
+
+    def handle(self):
+        # The server waits for the next request itself, without a thread
+        self.handle_one_request()
+
+    def log_error(self, *args):
+        if self.server.logRequests:
+            super().log_error(*args)
+
+
+class PooledXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
+    """
+    An XML-RPC server that handles requests on a fixed number of threads.
+    When they are all busy it stops accepting connections, which then
+    wait in the listen queue.
+
+    Between requests a kept-alive connection holds no thread. It is
+    watched with a selector by a separate thread, handed to the pool again
+    when the next request arrives, and closed after keep_alive idle
+    seconds. Clients must not pipeline requests, which xmlrpc.client does
+    not do.
+    """
+
+    request_queue_size = 64
+
+    def __init__(self, addr, workers=SERVER_WORKERS,
+                 request_timeout=REQUEST_TIMEOUT, keep_alive=KEEP_ALIVE,
+                 **kwargs):
+        super().__init__(addr, requestHandler=RequestHandler, **kwargs)
+        self.pool = ThreadPoolExecutor(workers)
+        self.slots = BoundedSemaphore(workers)
+        self.request_timeout = request_timeout
+        self.keep_alive = keep_alive
+        self.idle = selectors.DefaultSelector()
+        self.waiting = []
+        self.waiting_lock = Lock()
+        self.wakeup, self.waker = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.idle.register(self.wakeup, selectors.EVENT_READ)
+        self.closing = False
+        self.watcher = Thread(target=self.watch_idle, daemon=True)
+        self.watcher.start()
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        keep = False
+        try:
+            handler = self.finish_request(request, client_address)
+            keep = not handler.close_connection
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.slots.release()
+        if keep:
+            self.keep(request, client_address)
+        else:
+            self.shutdown_request(request)
+
+    def finish_request(self, request, client_address):
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def keep(self, request, client_address):
+        """
+        Hands a connection to the idle watcher until its next request.
+        """
+        with self.waiting_lock:
+            self.waiting.append((request, client_address))
+        self.waker.send(b'\0')
+
+    def watch_idle(self):
+        while not self.closing:
+            for key, events in self.idle.select(min(self.keep_alive, 1)):
+                if key.fileobj is self.wakeup:
+                    try:
+                        self.wakeup.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                self.idle.unregister(key.fileobj)
+                try:
+                    self.process_request(key.fileobj, key.data[0])
+                except RuntimeError:
+                    # The pool has been shut down
+                    self.shutdown_request(key.fileobj)
+                    return
+            with self.waiting_lock:
+                waiting, self.waiting = self.waiting, []
+            now = monotonic()
+            for request, client_address in waiting:
+                self.idle.register(request, selectors.EVENT_READ,
+                                   (client_address, now + self.keep_alive))
+            for key in list(self.idle.get_map().values()):
+                if key.fileobj is not self.wakeup and key.data[1] < now:
+                    self.idle.unregister(key.fileobj)
+                    self.shutdown_request(key.fileobj)
+
+    def server_close(self):
+        self.closing = True
+        self.waker.send(b'\0')
+        self.watcher.join()
+        for key in list(self.idle.get_map().values()):
+            if key.fileobj is not self.wakeup:
+                self.shutdown_request(key.fileobj)
+        self.idle.close()
+        self.wakeup.close()
+        self.waker.close()
+        super().server_close()
+        self.pool.shutdown()
+
+
 class Node:
     """
     A node in a peer-to-peer network.
     """
 
-    def __init__(self, url, dirname, secret):
+    def __init__(self, url, dirname, secret, parallel=True, timeout=TIMEOUT,
+                 max_workers=MAX_WORKERS, workers=SERVER_WORKERS,
+                 request_timeout=REQUEST_TIMEOUT, cache_size=CACHE_SIZE,
+                 hit_ttl=HIT_TTL, miss_ttl=MISS_TTL):
+        """
+        With parallel set, queries are broadcast to all known Nodes at once
+        and the first answer wins; otherwise they are asked one at a time.
+        Each Node gets timeout seconds to answer.
+
+        The server handles up to workers requests at once, or one at a time
+        if workers is None.
+
+        The Node remembers which known Node answered a query for hit_ttl
+        seconds and asks it directly next time, and that no Node could
+        answer for miss_ttl seconds.
+        """
         self.url = url
         self.dirname = dirname
         self.secret = secret
         self.known = set()
+        self.parallel = parallel
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(max_workers) if parallel else None
+        self.transport = PooledTransport(timeout)
+        self.workers = workers
+        self.request_timeout = request_timeout
+        self.lookups = LookupCache(cache_size)
+        self.hit_ttl = hit_ttl
+        self.miss_ttl = miss_ttl
 
     def query(self, query, history=[]):
         """
@@ -70,7 +410,30 @@ class Node:
         except UnhandledQuery:
             history = history + [self.url]
             if len(history) >= MAX_HISTORY_LENGTH: raise
-            return self._broadcast(query, history)
+            return self._forward(query, history, 'query')
+
+    def locate(self, query, history=[]):
+        """
+        Like query, but returns the URL of a Node that has the file.
+        """
+        try:
+            self._path(query)
+            return self.url
+        except UnhandledQuery:
+            history = history + [self.url]
+            if len(history) >= MAX_HISTORY_LENGTH: raise
+            return self._forward(query, history, 'locate')
+
+    def read(self, query, index):
+        """
+        Returns the chunk with the given index of a file, CHUNK_SIZE bytes
+        or fewer at the end. A shorter chunk means the end of the file has
+        been reached. Chunks are numbered rather than addressed by byte
+        offset, since XML-RPC integers stop at 2 ** 31 - 1.
+        """
+        with open(self._path(query), 'rb') as f:
+            f.seek(index * CHUNK_SIZE)
+            return Binary(f.read(CHUNK_SIZE))
 
     def hello(self, other):
         """
@@ -81,49 +444,139 @@ class Node:
 
     def fetch(self, query, secret):
         """
-        Used to make the Node find a file and download it.
+        Used to make the Node find a file and download it. The file is
+        copied a chunk at a time into a temporary file, which replaces the
+        old one only when it is complete.
         """
         if secret != self.secret: raise AccessDenied
-        result = self.query(query)
-        f = open(join(self.dirname, query), 'w')
-        f.write(result)
-        f.close()
+        name = join(self.dirname, query)
+        if not inside(self.dirname, name): raise AccessDenied
+        url = self.locate(query)
+        if url == self.url: return 0
+        s = ServerProxy(url, transport=self.transport)
+        fd, temp = mkstemp(dir=self.dirname, prefix='.', suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                index = 0
+                while True:
+                    data = s.read(query, index).data
+                    f.write(data)
+                    if len(data) < CHUNK_SIZE: break
+                    index += 1
+            os.replace(temp, name)
+        except:
+            os.unlink(temp)
+            raise
         return 0
 
     def _start(self):
         """
         Used internally to start the XML-RPC server.
         """
-        s = SimpleXMLRPCServer(("", get_port(self.url)), logRequests=False)
+        addr = ("", get_port(self.url))
+        if self.workers is None:
+            s = SimpleXMLRPCServer(addr, logRequests=False)
+        else:
+            s = PooledXMLRPCServer(addr, self.workers, self.request_timeout,
+                                   logRequests=False)
         s.register_instance(self)
         s.serve_forever()
 
-    def _handle(self, query):
+    def _path(self, query):
         """
-        Used internally to handle queries.
+        Used internally to find the file a query asks for.
         """
         dir = self.dirname
         name = join(dir, query)
         if not isfile(name): raise UnhandledQuery
         if not inside(dir, name): raise AccessDenied
-        return open(name).read()
+        return name
 
-    def _broadcast(self, query, history):
+    def _handle(self, query):
+        """
+        Used internally to handle queries.
         """
-        Used internally to broadcast a query to all known Nodes.
+        with open(self._path(query)) as f:
+            return f.read()
+
+    def _ask(self, other, method, query, history):
         """
-        for other in self.known.copy():
-            if other in history: continue
-            try:
-                s = ServerProxy(other)
-                return s.query(query, history)
-            except Fault as f:
-                if f.faultCode == UNHANDLED:
+        Used internally to pass a query on to another Node. Each hop gives
+        the next one a smaller share of its timeout, so a dead Node far
+        down the chain makes its caller give up before the caller's own
+        caller does. The Node is forgotten if it refuses the query, or
+        after MAX_FAILURES failed requests in a row that were not just
+        timeouts.
+        """
+        timeout = self.timeout
+        if timeout is not None:
+            timeout *= HOP_FACTOR ** (len(history) - 1)
+        try:
+            s = ServerProxy(other, transport=self.transport.with_timeout(
+                timeout))
+            return getattr(s, method)(query, history)
+        except Fault as f:
+            if f.faultCode != UNHANDLED: self.known.discard(other)
+            raise
+        except TimeoutError:
+            raise
+        except:
+            if self.transport.failures(urlparse(other)[1]) >= MAX_FAILURES:
+                self.known.discard(other)
+            raise
+
+    def _forward(self, query, history, method):
+        """
+        Used internally to pass on a query this Node couldn't handle, to
+        the Node that answered it last time if there is one and otherwise
+        to all known Nodes. A miss is only trusted by queries that have
+        come at least as far, since the search behind it went no further
+        than theirs would.
+        """
+        cached = self.lookups.get(query)
+        if cached is not None:
+            other, depth = cached
+            if other is None:
+                if len(history) >= depth: raise UnhandledQuery
+            elif other not in history:
+                try:
+                    return self._ask(other, method, query, history)
+                except Exception:
+                    self.lookups.pop(query)
+        try:
+            other, result = self._broadcast(query, history, method)
+        except UnhandledQuery:
+            self.lookups.put(query, (None, len(history)), self.miss_ttl)
+            raise
+        self.lookups.put(query, (other, None), self.hit_ttl)
+        return result
+
+    def _broadcast(self, query, history, method='query'):
+        """
+        Used internally to broadcast a query to all known Nodes, calling
+        the given method on them. Returns the Node that answered first
+        along with its answer.
+        """
+        others = [other for other in self.known.copy()
+                  if other not in history]
+        if not self.parallel:
+            for other in others:
+                try:
+                    return other, self._ask(other, method, query, history)
+                except Exception:
                     pass
-                else:
-                    self.known.remove(other)
-            except:
-                self.known.remove(other)
+            raise UnhandledQuery
+        futures = {self.pool.submit(self._ask, other, method, query,
+                                    history): other
+                   for other in others}
+        try:
+            for future in as_completed(futures):
+                if future.exception() is None:
+                    return futures[future], future.result()
+        finally:
+            # Nodes that have not been asked yet no longer need to be
+            for future in futures:
+                future.cancel()
         raise UnhandledQuery
 
 